@@ -1,6 +1,8 @@
 import streamlit as st
-from supabase import create_client
 import modules.auth as auth
+import modules.transport as transport
+import modules.scheduler as scheduler
+import modules.services as services
 
 import modules.ui_v2 as ui_v2
 import modules.i18n as i18n
@@ -21,10 +23,19 @@ except FileNotFoundError:
     st.error("Secrets file not found. Please set up .streamlit/secrets.toml")
     st.stop()
 
+# Per-session client (own auth state) over the process-wide connection pool
 if "supabase_client" not in st.session_state:
-    st.session_state["supabase_client"] = create_client(url, key)
+    st.session_state["supabase_client"] = transport.create_session_client(url, key)
 supabase = st.session_state["supabase_client"]
 
+# Optional in-app recurring scheduler: one per server process, needs the service key
+scheduler_conf = st.secrets.get("scheduler", {})
+if scheduler_conf.get("enabled") and scheduler_conf.get("service_key") and not scheduler.is_running():
+    scheduler.start(
+        transport.create_session_client(url, scheduler_conf["service_key"]),
+        on_written=lambda owners: services.note_external_write(owners, "expenses", "recurring_rules"),
+    )
+
 # 3. Authentication Check
 if "session" not in st.session_state:
     st.session_state["session"] = None
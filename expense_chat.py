@@ -3,6 +3,7 @@ import json
 import datetime
 import streamlit as st
 import pandas as pd
+import modules.ledger as ledger
 
 def get_openai_client():
     api_key = None
@@ -121,8 +122,7 @@ def process_user_message(user_text, df, budgets=None, recurring=None, user_curre
     context_exp = "[]"
     if not df.empty:
         df_sorted = df.sort_values(by="id", ascending=False).head(50)
-        safe_cols = [c for c in ["id", "date", "item", "amount", "category", "note"] if c in df_sorted.columns]
-        context_exp = json.dumps(df_sorted[safe_cols].to_dict(orient="records"), ensure_ascii=False)
+        context_exp = json.dumps(ledger.to_records(df_sorted), ensure_ascii=False)
 
     # 2. Budgets Context
     context_bud = "[]"
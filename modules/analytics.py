@@ -0,0 +1,102 @@
+from types import MappingProxyType
+from typing import NamedTuple, Tuple, Mapping
+import modules.ledger as ledger
+
+# =========================================================
+# Month snapshot
+# ---------------------------------------------------------
+# Everything the KPI header and budget cards show for the current month,
+# computed in one pass (a single groupby over the month's rows, or none at
+# all when the precomputed monthly summary is available). The result is
+# immutable so it can be cached and shared between widgets and reruns.
+# =========================================================
+
+# Monthly equivalent of one charge, per recurring frequency
+SUBSCRIPTION_MONTHLY_FACTOR = {"Weekly": 52 / 12, "Monthly": 1.0, "Yearly": 1 / 12}
+
+class BudgetStatus(NamedTuple):
+    id: object
+    name: str
+    category: str
+    limit: float
+    spent: float
+    left: float
+    pct: float              # spent / limit (0 when limit is 0)
+    daily_allowance: float  # left / days_left, 0 when nothing is left
+
+class MonthSnapshot(NamedTuple):
+    month: int                          # yyyymm
+    total: float
+    count: int
+    spend_by_category: Mapping[str, float]
+    budgets: Tuple[BudgetStatus, ...]
+    budget_total: float
+    budget_left: float                  # sum of (limit - spent) over budgets
+    day: int
+    days_in_month: int
+    days_left: int
+    daily_pace: float                   # average spend per elapsed day
+    projected_total: float              # daily_pace * days_in_month
+    active_subscriptions: int
+    subscription_load: float            # monthly cost of the active rules
+
+def compute_month_snapshot(df, budgets, rules, now, category_totals=None):
+    """
+    Builds the MonthSnapshot for the month containing `now` (tz-aware Timestamp).
+
+    df:              canonical expense frame (modules/ledger.py)
+    budgets, rules:  rows as returned by services.get_budgets / get_recurring_rules
+    category_totals: optional frame (category, total, count) for that month,
+                     e.g. services.get_month_summary; `df` is not scanned then
+    """
+    month = ledger.month_code(now)
+    if category_totals is not None:
+        spend = dict(zip(category_totals["category"], category_totals["total"].astype(float)))
+        count = int(category_totals["count"].sum())
+    else:
+        month_df = df[df["month"] == month]
+        sums = month_df.groupby("category", observed=True)["amount_cents"].agg(["sum", "size"])
+        spend = {cat: cents / 100 for cat, cents in sums["sum"].items()}
+        count = int(sums["size"].sum())
+    total = float(sum(spend.values()))
+
+    day = now.day
+    days_in_month = now.days_in_month
+    days_left = days_in_month - day
+
+    statuses = []
+    for b in budgets or []:
+        limit = float(b.get("amount") or 0)
+        spent = float(spend.get(b.get("category"), 0))
+        left = limit - spent
+        statuses.append(BudgetStatus(
+            id=b.get("id"),
+            name=b.get("name") or b.get("category"),
+            category=b.get("category"),
+            limit=limit,
+            spent=spent,
+            left=left,
+            pct=spent / limit if limit > 0 else 0.0,
+            daily_allowance=left / days_left if days_left > 0 and left > 0 else 0.0,
+        ))
+
+    rules = rules or []
+    load = sum(float(r.get("amount") or 0) * SUBSCRIPTION_MONTHLY_FACTOR.get(r.get("frequency"), 1.0) for r in rules)
+    pace = total / day if day else 0.0
+
+    return MonthSnapshot(
+        month=month,
+        total=total,
+        count=count,
+        spend_by_category=MappingProxyType(spend),
+        budgets=tuple(statuses),
+        budget_total=sum(s.limit for s in statuses),
+        budget_left=sum(s.left for s in statuses),
+        day=day,
+        days_in_month=days_in_month,
+        days_left=days_left,
+        daily_pace=pace,
+        projected_total=pace * days_in_month,
+        active_subscriptions=len(rules),
+        subscription_load=load,
+    )
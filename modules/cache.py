@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with a time-to-live per entry.
+    One instance is shared by every Streamlit session in the process,
+    so keys must carry the user they belong to.
+    Entries can be tagged (e.g. with (user, table)) and dropped by tag.
+    """
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # tag -> keys of the entries carrying it
+        self._tagged = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        _expires_at, _value, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def get(self, key, default=_MISSING):
+        """
+        Returns the cached value, or `default` when missing or expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value, _tags = entry
+            if expires_at <= now:
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags=()):
+        now = time.monotonic()
+        with self._lock:
+            # Expired entries may never be read again (their key is outdated):
+            # sweep them here rather than wait for the LRU bound
+            for old in [k for k, entry in self._data.items() if entry[0] <= now]:
+                self._remove(old)
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (now + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def evict(self, tag):
+        """
+        Drops every entry tagged with `tag`.
+        """
+        with self._lock:
+            for key in list(self._tagged.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tagged.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DataVersions:
+    """
+    Monotonic version counter per (user, table).
+    Writes bump the counter; cache keys embed it, so stale entries are
+    never looked up again. With a `cache`, a bump also evicts the entries
+    tagged (user, table), so superseded values are freed at once.
+    """
+
+    def __init__(self, cache=None):
+        self._versions = {}
+        self._cache = cache
+        self._lock = threading.Lock()
+
+    def get(self, owner, table):
+        return self._versions.get((owner, table), 0)
+
+    def bump(self, owner, table):
+        with self._lock:
+            key = (owner, table)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            version = self._versions[key]
+        if self._cache is not None:
+            self._cache.evict(key)
+        return version
+
+
+def is_missing(value):
+    return value is _MISSING
@@ -0,0 +1,102 @@
+import datetime
+import pandas as pd
+
+class ChangeSet:
+    """
+    Minimal set of writes that turns `original` into `edited`.
+
+    - inserts: new rows (no key yet), tracked columns only
+    - updates: {key: id, <changed columns>} per modified row
+    - deletes: ids removed from the editor or flagged for deletion
+    """
+
+    def __init__(self, key="id"):
+        self.key = key
+        self.inserts = []
+        self.updates = []
+        self.deletes = []
+        self._rows = {}
+
+    @property
+    def update_rows(self):
+        """
+        Modified rows with every tracked column, for a single bulk upsert
+        (PostgREST needs uniform keys, and an upsert must satisfy NOT NULL
+        even when it ends up updating).
+        """
+        return [self._rows[u[self.key]] for u in self.updates]
+
+    def is_empty(self):
+        return not (self.inserts or self.updates or self.deletes)
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates) + len(self.deletes)
+
+    def __repr__(self):
+        return f"ChangeSet(inserts={len(self.inserts)}, updates={len(self.updates)}, deletes={len(self.deletes)})"
+
+
+def _is_null(value):
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+# Stands in for None/NaN during comparison (pandas treats None != None)
+_NULL = "\x00null"
+
+def _comparable(value):
+    # Editors may hand back dates as Timestamp or datetime.date and whole
+    # numbers as int or float; compare on a common representation.
+    if _is_null(value):
+        return _NULL
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, float):
+        return round(value, 6)
+    if hasattr(value, "item"):
+        return _comparable(value.item())
+    return value
+
+def diff_frames(original, edited, columns, key="id", delete_col=None, required=(), rename=None):
+    """
+    Compares an st.data_editor result with the frame it was given.
+
+    columns:    columns whose edits should be persisted
+    delete_col: optional checkbox column that marks rows for deletion
+    required:   inserts missing any of these are dropped (half-filled new rows)
+    rename:     {frame column: db column} applied to every emitted payload
+    """
+    rename = rename or {}
+    changes = ChangeSet(key=key)
+
+    def payload(row, cols):
+        return {rename.get(c, c): (None if _is_null(row[c]) else row[c]) for c in cols}
+
+    flagged = edited[delete_col].fillna(False).astype(bool) if delete_col else pd.Series(False, index=edited.index)
+    has_key = edited[key].notna()
+
+    # 1. Inserts: rows added in the editor
+    for _idx, row in edited[~has_key & ~flagged].iterrows():
+        if any(_is_null(row[c]) for c in required):
+            continue
+        changes.inserts.append(payload(row, columns))
+
+    # 2. Deletes: flagged rows and rows removed from the editor
+    kept = edited[has_key & ~flagged]
+    orig_ids = set(original[key].dropna())
+    changes.deletes = sorted(orig_ids - set(kept[key]))
+
+    # 3. Updates: vectorized cell comparison on the rows present in both
+    kept = kept[kept[key].isin(orig_ids)].drop_duplicates(subset=key).set_index(key)
+    if kept.empty:
+        return changes
+    before = original.drop_duplicates(subset=key).set_index(key).loc[kept.index, columns].astype(object)
+    after = kept[columns].astype(object)
+    changed_mask = before.apply(lambda col: col.map(_comparable)) != after.apply(lambda col: col.map(_comparable))
+    for row_id in changed_mask.index[changed_mask.any(axis=1)]:
+        changed_cols = [c for c in columns if changed_mask.at[row_id, c]]
+        row = after.loc[row_id]
+        changes.updates.append({key: row_id, **payload(row, changed_cols)})
+        changes._rows[row_id] = {key: row_id, **payload(row, columns)}
+    return changes
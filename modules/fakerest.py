@@ -0,0 +1,308 @@
+import csv
+import time
+import operator
+import uuid
+import random
+import datetime
+import threading
+import modules.recurring as recurring
+import modules.restclient as restclient
+
+# =========================================================
+# In-memory PostgREST stand-in (standard library only)
+# ---------------------------------------------------------
+# Answers the same requests modules/restclient.py would send to Supabase
+# (select / insert / upsert / update / delete with eq, neq, gt, gte, lt,
+# lte and in filters, order, limit, and the materialize_recurring_expenses
+# RPC), from tables held in memory. Used by the --dry-run / --benchmark
+# modes of scripts/cron_job.py: the real code paths run unchanged, nothing
+# touches a live project, and every request is counted as the round trip
+# it would have been. `latency_ms` adds a sleep per request to model the
+# network.
+#
+# `as_user(user_id)` returns a client that behaves like a signed-in
+# session: RLS-style scoping of reads and writes, and inserts default
+# `user_id` to that user (for services.check_and_process_recurring).
+# =========================================================
+
+# Unique keys enforced on insert (Postgres constraints in supabase_setup.sql)
+UNIQUE_KEYS = {"expenses": [("rule_id", "period_key")]}
+# Columns whose value the database sets on insert / update
+TOUCHED_ON_UPDATE = {"expenses": "updated_at"}
+
+CATEGORIES = ["餐饮", "日用品", "交通", "服饰", "医疗", "娱乐", "居住", "其他"]
+ITEMS = ["Coffee", "Lunch", "Taxi", "Groceries", "Netflix", "Rent", "Movie", "Pharmacy"]
+FREQUENCIES = ["Monthly", "Monthly", "Weekly", "Yearly"]
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def _parse_list(text):
+    # "(1,2,\"a,b\")" -> ["1", "2", "a,b"]
+    return next(csv.reader([text[1:-1]], quotechar='"', escapechar="\\"), [])
+
+def _coerce(value, like):
+    # Filter values arrive as text; compare them as the stored column type
+    if isinstance(like, bool):
+        return value == "true"
+    if isinstance(like, int):
+        return int(value)
+    if isinstance(like, float):
+        return float(value)
+    return value
+
+_COMPARE = {
+    "eq": operator.eq,
+    "neq": operator.ne,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+}
+
+def _predicate(column, expression):
+    """
+    Compiles one PostgREST filter (column=op.value) into a row test.
+    """
+    op, _, value = expression.partition(".")
+    if op == "is":
+        return lambda row: row.get(column) is None if value == "null" else row.get(column) == (value == "true")
+    if op == "in":
+        values, by_type = _parse_list(value), {}
+        def test(row):
+            current = row.get(column)
+            if current is None:
+                return False
+            if type(current) not in by_type:
+                by_type[type(current)] = {_coerce(v, current) for v in values}
+            return current in by_type[type(current)]
+        return test
+    if op not in _COMPARE:
+        raise restclient.APIError(400, f"unsupported operator {op}")
+    compare = _COMPARE[op]
+    def test(row):
+        current = row.get(column)
+        return current is not None and compare(current, _coerce(value, current))
+    return test
+
+class Store:
+    """
+    The tables and request counters, shared by a client and its `as_user` views.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.next_id = {}
+        self.calls = {}
+        # (table, columns) -> {values: row}, built on first use
+        self.indexes = {}
+        self.lock = threading.RLock()
+
+    def rows(self, table):
+        return self.tables.setdefault(table, [])
+
+    def add(self, table, row):
+        # Direct write (seeding), not counted as a request
+        row = dict(row)
+        if row.get("id") is None:
+            row["id"] = self.next_id.get(table, 1)
+        self.next_id[table] = max(self.next_id.get(table, 1), row["id"] + 1)
+        self.rows(table).append(row)
+        for (name, columns), index in self.indexes.items():
+            if name == table:
+                index[tuple(row.get(c) for c in columns)] = row
+        return row
+
+    def lookup(self, table, columns, row):
+        key = (table, columns)
+        if key not in self.indexes:
+            self.indexes[key] = {tuple(r.get(c) for c in columns): r for r in self.rows(table)}
+        return self.indexes[key].get(tuple(row.get(c) for c in columns))
+
+    def changed(self, table):
+        # Rows were edited or removed: rebuild that table's indexes lazily
+        self.indexes = {k: v for k, v in self.indexes.items() if k[0] != table}
+
+class FakeClient(restclient.Client):
+    def __init__(self, store=None, latency_ms=0, user_id=None):
+        self.store = store or Store()
+        self.latency_ms = latency_ms
+        self.user_id = user_id
+
+    def as_user(self, user_id):
+        return FakeClient(self.store, latency_ms=self.latency_ms, user_id=user_id)
+
+    def round_trips(self):
+        """
+        {"GET recurring_rules": n, "POST expenses": n, ...} since the last reset.
+        """
+        with self.store.lock:
+            return dict(self.store.calls)
+
+    def reset_round_trips(self):
+        with self.store.lock:
+            self.store.calls.clear()
+
+    # --- restclient.Client transport ---
+    def request(self, method, path, params, body, prefer):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        name = path.strip("/")
+        with self.store.lock:
+            label = f"{method} {name}"
+            self.store.calls[label] = self.store.calls.get(label, 0) + 1
+            if name.startswith("rpc/"):
+                return self._rpc(name[4:], body or {})
+            filters, options = [], {}
+            for key, value in params:
+                if key in ("select", "order", "limit", "offset", "on_conflict"):
+                    options[key] = value
+                else:
+                    filters.append((key, value))
+            if method == "GET":
+                return self._select(name, filters, options)
+            if method == "POST":
+                return self._insert(name, body, options.get("on_conflict"), prefer)
+            if method == "PATCH":
+                return self._update(name, filters, body)
+            if method == "DELETE":
+                return self._delete(name, filters)
+        raise restclient.APIError(405, f"unsupported method {method}")
+
+    def _visible(self, table, filters):
+        rows = self.store.rows(table)
+        if self.user_id is not None:
+            rows = [r for r in rows if r.get("user_id") == self.user_id]
+        tests = [_predicate(column, expr) for column, expr in filters]
+        return [r for r in rows if all(test(r) for test in tests)]
+
+    def _select(self, table, filters, options):
+        rows = self._visible(table, filters)
+        for part in reversed(options.get("order", "").split(",") if options.get("order") else []):
+            column, _, direction = part.partition(".")
+            # Nulls last, as in Postgres ascending order
+            rows = sorted(rows, key=lambda r: (r.get(column) is None, r.get(column) if r.get(column) is not None else 0),
+                          reverse=direction.startswith("desc"))
+        offset = int(options.get("offset", 0))
+        rows = rows[offset:]
+        if "limit" in options:
+            rows = rows[:int(options["limit"])]
+        return [dict(r) for r in rows]
+
+    def _conflict(self, table, row, columns):
+        keys = [columns] if columns else UNIQUE_KEYS.get(table, [])
+        for key in keys + [("id",)]:
+            # Nulls never conflict
+            if all(row.get(c) is not None for c in key):
+                existing = self.store.lookup(table, key, row)
+                if existing is not None:
+                    return existing
+        return None
+
+    def _insert(self, table, body, on_conflict, prefer):
+        rows = body if isinstance(body, list) else [body]
+        columns = tuple(on_conflict.split(",")) if on_conflict else None
+        ignore = "resolution=ignore-duplicates" in prefer
+        merge = "resolution=merge-duplicates" in prefer
+        written = []
+        for row in rows:
+            row = dict(row)
+            if self.user_id is not None:
+                row.setdefault("user_id", self.user_id)
+                if row["user_id"] != self.user_id:
+                    raise restclient.APIError(403, "new row violates row-level security policy")
+            existing = self._conflict(table, row, columns)
+            if existing is not None:
+                if ignore:
+                    continue
+                if not merge:
+                    raise restclient.APIError(409, f"duplicate key value violates unique constraint on {table}")
+                existing.update(row)
+                self.store.changed(table)
+                written.append(dict(existing))
+                continue
+            row.setdefault("created_at", _now())
+            if table in TOUCHED_ON_UPDATE:
+                row.setdefault(TOUCHED_ON_UPDATE[table], _now())
+            written.append(dict(self.store.add(table, row)))
+        return written
+
+    def _update(self, table, filters, values):
+        rows = self._visible(table, filters)
+        for row in rows:
+            row.update(values)
+            if table in TOUCHED_ON_UPDATE:
+                row[TOUCHED_ON_UPDATE[table]] = _now()
+        self.store.changed(table)
+        return [dict(r) for r in rows]
+
+    def _delete(self, table, filters):
+        doomed = {id(r) for r in self._visible(table, filters)}
+        removed = [r for r in self.store.rows(table) if id(r) in doomed]
+        self.store.tables[table] = [r for r in self.store.rows(table) if id(r) not in doomed]
+        self.store.changed(table)
+        return [dict(r) for r in removed]
+
+    def _rpc(self, fn, args):
+        if fn != "materialize_recurring_expenses":
+            raise restclient.APIError(404, f"function {fn} not found")
+        # Same rules as the SQL function: signed-in callers get their own
+        # rules as of today; otherwise p_user / p_today apply
+        owner = self.user_id or args.get("p_user")
+        day = recurring.today()
+        if self.user_id is None and args.get("p_today"):
+            day = datetime.date.fromisoformat(args["p_today"])
+        rules = [r for r in self.store.rows("recurring_rules")
+                 if r.get("active") and (owner is None or r.get("user_id") == owner)]
+        payloads, _outcomes, advance = recurring.plan(rules, day, source=args.get("p_source", "recurring_rule"))
+        inserted = FakeClient(self.store)._insert("expenses", payloads, "rule_id,period_key",
+                                                  ["resolution=ignore-duplicates"])
+        advance = set(advance)
+        for rule in rules:
+            if rule["id"] in advance:
+                rule["last_run_date"] = day.isoformat()
+        return [{k: row[k] for k in ("rule_id", "user_id", "date", "period_key")} for row in inserted]
+
+def seed(client, users=100, rules_per_user=5, expenses_per_user=200, gap_days=30, day=None, seed=42):
+    """
+    Fills the client's store with deterministic synthetic data: `users`
+    users, each with `rules_per_user` active rules (mixed frequencies, some
+    start dates, watermarks up to `gap_days` old or missing) and
+    `expenses_per_user` expenses over the past year. Returns the user ids.
+    """
+    rng = random.Random(seed)
+    day = day or recurring.today()
+    store = client.store
+    user_ids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(users)]
+    with store.lock:
+        for user_id in user_ids:
+            for n in range(rules_per_user):
+                frequency = rng.choice(FREQUENCIES)
+                start = day - datetime.timedelta(days=rng.randint(0, 800))
+                store.add("recurring_rules", {
+                    "name": f"Subscription {n + 1}",
+                    "amount": round(rng.uniform(1, 100), 2),
+                    "category": rng.choice(CATEGORIES),
+                    "frequency": frequency,
+                    "day": rng.randint(0, 6) if frequency == "Weekly" else rng.randint(1, 31),
+                    "active": True,
+                    "start_date": start.isoformat() if frequency == "Yearly" or rng.random() < 0.2 else None,
+                    "last_run_date": None if rng.random() < 0.1
+                    else (day - datetime.timedelta(days=rng.randint(0, gap_days))).isoformat(),
+                    "user_id": user_id,
+                    "created_at": _now(),
+                })
+            for _ in range(expenses_per_user):
+                store.add("expenses", {
+                    "date": (day - datetime.timedelta(days=rng.randint(0, 365))).isoformat(),
+                    "item": rng.choice(ITEMS),
+                    "amount": round(rng.uniform(1, 200), 2),
+                    "category": rng.choice(CATEGORIES),
+                    "note": "",
+                    "source": "manual",
+                    "rule_id": None,
+                    "period_key": None,
+                    "user_id": user_id,
+                    "created_at": _now(),
+                    "updated_at": _now(),
+                })
+    return user_ids
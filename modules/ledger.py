@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+# Categories constant (can be imported by UI)
+CATEGORIES = ["餐饮", "日用品", "交通", "服饰", "医疗", "娱乐", "居住", "其他"]
+CATEGORY_DTYPE = pd.CategoricalDtype(CATEGORIES)
+
+# Map legacy English categories to Chinese
+LEGACY_CATEGORY_MAP = {
+    "Dining": "餐饮", "Food": "餐饮",
+    "Transport": "交通", "Transportation": "交通",
+    "Shopping": "日用品", "Daily": "日用品",
+    "Housing": "居住", "Home": "居住",
+    "Medical": "医疗", "Health": "医疗",
+    "Entertainment": "娱乐", "Fun": "娱乐",
+    "Clothing": "服饰",
+    "Others": "其他", "Other": "其他", "General": "其他"
+}
+
+# =========================================================
+# Canonical expense frame
+# ---------------------------------------------------------
+#   id            int64
+#   date          datetime64[ns]
+#   item, note    object
+#   source        category
+#   category      category (CATEGORIES)
+#   amount_cents  int64      money is exact integer cents
+#   month         int32      yyyymm, e.g. 202610
+#   updated_at    datetime64[ns, UTC]  sync watermark
+#
+# Nothing localized lives in the frame. Display columns (日期, 项目, 金额 ...)
+# are produced by `to_display` at render time for the widgets that need them.
+# =========================================================
+COLUMNS = ["id", "date", "item", "amount_cents", "category", "note", "source", "month", "updated_at"]
+
+DISPLAY_COLUMNS = {
+    "date": "日期",
+    "item": "项目",
+    "amount": "金额",
+    "category": "分类",
+    "note": "备注",
+    "source": "来源",
+}
+
+def empty():
+    """
+    An empty frame that already has the canonical columns and dtypes.
+    """
+    return pd.DataFrame({
+        "id": pd.Series(dtype="int64"),
+        "date": pd.Series(dtype="datetime64[ns]"),
+        "item": pd.Series(dtype=object),
+        "amount_cents": pd.Series(dtype="int64"),
+        "category": pd.Series(dtype=CATEGORY_DTYPE),
+        "note": pd.Series(dtype=object),
+        "source": pd.Series(dtype="category"),
+        "month": pd.Series(dtype="int32"),
+        "updated_at": pd.Series(dtype="datetime64[ns, UTC]"),
+    })
+
+def from_rows(rows):
+    """
+    Builds the canonical frame from raw `expenses` rows.
+    """
+    if not rows:
+        return empty()
+
+    raw = pd.DataFrame(rows)
+    df = pd.DataFrame(index=raw.index)
+    df["id"] = pd.to_numeric(raw["id"], errors="coerce").fillna(0).astype("int64")
+    df["date"] = pd.to_datetime(raw["date"], errors="coerce")
+    df["item"] = raw.get("item", "")
+    df["amount_cents"] = to_cents(raw.get("amount", 0))
+    df["category"] = normalize_categories(raw["category"]) if "category" in raw.columns else pd.Categorical(["其他"] * len(raw), dtype=CATEGORY_DTYPE)
+    df["note"] = raw.get("note", "")
+    df["source"] = pd.Series(raw.get("source", ""), index=raw.index).astype("category")
+    df["month"] = month_codes(df["date"])
+    if "updated_at" in raw.columns:
+        df["updated_at"] = pd.to_datetime(raw["updated_at"], utc=True, errors="coerce", format="ISO8601")
+    else:
+        df["updated_at"] = pd.Series(pd.NaT, index=raw.index, dtype="datetime64[ns, UTC]")
+    return df
+
+def concat(frames):
+    """
+    pd.concat for canonical frames. Re-applies the `source` dtype, whose
+    categories differ between chunks and would otherwise decay to object.
+    """
+    df = pd.concat(frames, ignore_index=True)
+    df["source"] = df["source"].astype("category")
+    return df
+
+# Every accepted spelling -> canonical category
+_CATEGORY_LOOKUP = {**{c: c for c in CATEGORIES}, **LEGACY_CATEGORY_MAP}
+
+def normalize_categories(series):
+    """
+    Folds raw category strings into CATEGORIES as a Categorical.
+    Anything unknown becomes "其他".
+    """
+    series = pd.Series(series)
+    cats = pd.Categorical(series, dtype=CATEGORY_DTYPE)
+    # Fast path: migrated data is already canonical
+    if (cats.codes >= 0).all():
+        return cats
+    cats = pd.Categorical(series.map(_CATEGORY_LOOKUP), dtype=CATEGORY_DTYPE)
+    return cats.fillna("其他")
+
+def legacy_targets(values):
+    """
+    {canonical category: [raw values that should become it]} for the raw
+    values that are not canonical yet. None/NaN are left to the caller.
+    """
+    targets = {}
+    for value in set(values):
+        if value is None or value != value or value in CATEGORIES:
+            continue
+        targets.setdefault(_CATEGORY_LOOKUP.get(value, "其他"), []).append(value)
+    return targets
+
+def to_cents(values):
+    """
+    Converts amounts (numbers or numeric strings) to int64 cents.
+    """
+    amounts = pd.to_numeric(pd.Series(values), errors="coerce").fillna(0)
+    return np.round(amounts.to_numpy(dtype=float) * 100).astype("int64")
+
+def month_code(ts):
+    """
+    yyyymm integer for a date-like value.
+    """
+    return ts.year * 100 + ts.month
+
+def month_codes(dates):
+    codes = dates.dt.year * 100 + dates.dt.month
+    return codes.fillna(0).astype("int32")
+
+def month_label(code):
+    """
+    "YYYY-MM" for a yyyymm code.
+    """
+    code = int(code)
+    return f"{code // 100:04d}-{code % 100:02d}"
+
+def money(cents):
+    """
+    Cents (scalar, Series or array) back to currency units for display.
+    """
+    return cents / 100
+
+def spend_by_category(df):
+    """
+    {category: spent} in currency units over the given rows.
+    """
+    if df.empty:
+        return {}
+    sums = df.groupby("category", observed=True)["amount_cents"].sum()
+    return {cat: cents / 100 for cat, cents in sums.items()}
+
+def to_display(df, columns=("date", "item", "amount", "category", "note")):
+    """
+    Derives the localized display columns (日期, 项目, 金额 ...) for widgets
+    such as st.data_editor. `id` is always carried along.
+    """
+    out = pd.DataFrame(index=df.index)
+    for col in columns:
+        if col == "amount":
+            out[DISPLAY_COLUMNS[col]] = money(df["amount_cents"])
+        elif col in ("category", "source"):
+            out[DISPLAY_COLUMNS[col]] = df[col].astype(object)
+        else:
+            out[DISPLAY_COLUMNS[col]] = df[col]
+    out["id"] = df["id"]
+    return out
+
+def to_records(df):
+    """
+    Plain JSON-serialisable dicts (id, date, item, amount, category, note).
+    """
+    if df.empty:
+        return []
+    out = pd.DataFrame({
+        "id": df["id"].astype(int),
+        "date": df["date"].dt.strftime("%Y-%m-%d"),
+        "item": df["item"],
+        "amount": money(df["amount_cents"]),
+        "category": df["category"].astype(object),
+        "note": df["note"].fillna(""),
+    })
+    return out.to_dict(orient="records")
@@ -0,0 +1,223 @@
+import json
+import os
+import time
+import bisect
+import functools
+import threading
+import contextvars
+import pandas as pd
+import streamlit as st
+
+# =========================================================
+# Services latency metrics
+# ---------------------------------------------------------
+# Every public function in modules/services.py is wrapped with `instrument`.
+# Per (function, page) we keep: call count, errors, a latency histogram,
+# rows returned and response bytes (measured on the wire by an httpx
+# response hook, see modules/transport.py).
+#
+# Configured in .streamlit/secrets.toml:
+#   [debug]
+#   metrics_panel = true                 # sidebar panel for the current rerun
+#   metrics_file = "metrics/services.prom"   # Prometheus textfile, rewritten each rerun
+#   metrics_jsonl = "metrics/calls.jsonl"    # one JSON line per call, appended
+# =========================================================
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_lock = threading.Lock()
+_stats = {}
+
+# The call currently running (innermost) and the page being rendered
+_current_call = contextvars.ContextVar("services_call", default=None)
+_current_page = contextvars.ContextVar("services_page", default="")
+# Call records of the current rerun (shared with worker threads via copied contexts)
+_rerun_calls = contextvars.ContextVar("services_rerun_calls", default=None)
+
+def _settings():
+    try:
+        return st.secrets.get("debug", {})
+    except Exception:
+        return {}
+
+def begin_rerun(page):
+    """
+    Tags the calls of this script run with `page` and starts a fresh
+    per-rerun record list for the debug panel.
+    """
+    _current_page.set(page)
+    _rerun_calls.set([])
+
+def _new_stat():
+    return {"count": 0, "errors": 0, "total_ms": 0.0, "rows": 0, "bytes": 0,
+            "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+
+def _count_rows(value):
+    if isinstance(value, (pd.DataFrame, list)):
+        return len(value)
+    return 0
+
+def _is_failure(value):
+    # services report most failures through the return value
+    if value is False:
+        return True
+    return isinstance(value, tuple) and len(value) == 2 and value[0] is False
+
+def record(function, page, elapsed_ms, rows=0, nbytes=0, error=False):
+    with _lock:
+        stat = _stats.setdefault((function, page), _new_stat())
+        stat["count"] += 1
+        stat["errors"] += int(error)
+        stat["total_ms"] += elapsed_ms
+        stat["rows"] += rows
+        stat["bytes"] += nbytes
+        stat["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+def instrument(fn):
+    """
+    Decorator that times a services function and records its outcome.
+    Exceptions are counted as errors and re-raised unchanged.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        call = {"bytes": 0, "error": False}
+        token = _current_call.set(call)
+        start = time.perf_counter()
+        value = None
+        try:
+            value = fn(*args, **kwargs)
+            return value
+        except Exception:
+            call["error"] = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            _current_call.reset(token)
+            error = call["error"] or _is_failure(value)
+            page = _current_page.get()
+            rows = _count_rows(value)
+            record(fn.__name__, page, elapsed_ms, rows, call["bytes"], error)
+            # Nested calls: the outer call also saw these bytes
+            parent = _current_call.get()
+            if parent is not None:
+                parent["bytes"] += call["bytes"]
+                parent["error"] = parent["error"] or call["error"]
+            entry = {"ts": time.time(), "function": fn.__name__, "page": page,
+                     "ms": round(elapsed_ms, 2), "rows": rows, "bytes": call["bytes"], "error": error}
+            calls = _rerun_calls.get()
+            if calls is not None:
+                calls.append(entry)
+            _append_jsonl(entry)
+    return wrapper
+
+def note_error():
+    """
+    Marks the running call as failed (for errors a function handles itself).
+    """
+    call = _current_call.get()
+    if call is not None:
+        call["error"] = True
+
+def on_response(response):
+    """
+    httpx response hook: attributes wire bytes and HTTP errors to the
+    services call that issued the request.
+    """
+    call = _current_call.get()
+    if call is None:
+        return
+    response.read()
+    call["bytes"] += response.num_bytes_downloaded
+    if response.status_code >= 400:
+        call["error"] = True
+
+def snapshot():
+    with _lock:
+        return {key: {**stat, "buckets": list(stat["buckets"])} for key, stat in _stats.items()}
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def _labels(function, page, **extra):
+    pairs = {"function": function, "page": page or "none", **extra}
+    return ",".join(f'{k}="{v}"' for k, v in pairs.items())
+
+def to_prometheus():
+    """
+    All metrics since process start in Prometheus text exposition format.
+    """
+    stats = snapshot()
+    lines = [
+        "# HELP services_call_duration_ms Latency of modules.services calls.",
+        "# TYPE services_call_duration_ms histogram",
+    ]
+    for (function, page), stat in sorted(stats.items()):
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS + ("+Inf",), stat["buckets"]):
+            cumulative += n
+            lines.append(f"services_call_duration_ms_bucket{{{_labels(function, page, le=bound)}}} {cumulative}")
+        lines.append(f"services_call_duration_ms_sum{{{_labels(function, page)}}} {stat['total_ms']:.3f}")
+        lines.append(f"services_call_duration_ms_count{{{_labels(function, page)}}} {stat['count']}")
+    for name, field, help_text in (
+        ("services_call_errors_total", "errors", "Failed modules.services calls."),
+        ("services_rows_total", "rows", "Rows returned by modules.services calls."),
+        ("services_response_bytes_total", "bytes", "Response bytes received by modules.services calls."),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for (function, page), stat in sorted(stats.items()):
+            lines.append(f"{name}{{{_labels(function, page)}}} {stat[field]}")
+    return "\n".join(lines) + "\n"
+
+def to_jsonl():
+    """
+    One JSON object per (function, page) with the aggregated metrics.
+    """
+    lines = []
+    for (function, page), stat in sorted(snapshot().items()):
+        buckets = dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ["+Inf"], stat["buckets"]))
+        lines.append(json.dumps({"function": function, "page": page, **{k: v for k, v in stat.items() if k != "buckets"},
+                                 "buckets_ms": buckets}, ensure_ascii=False))
+    return "\n".join(lines) + ("\n" if lines else "")
+
+def _append_jsonl(entry):
+    path = _settings().get("metrics_jsonl")
+    if not path:
+        return
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print(f"Failed to write metrics: {e}")
+
+def flush():
+    """
+    Rewrites the Prometheus textfile (for node_exporter's textfile collector)
+    when `metrics_file` is configured.
+    """
+    path = _settings().get("metrics_file")
+    if not path:
+        return
+    try:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(to_prometheus())
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"Failed to write metrics: {e}")
+
+def render_debug_panel():
+    """
+    Sidebar expander listing this rerun's services calls, plus downloads of
+    the process-wide metrics. Only shown when `metrics_panel` is enabled.
+    """
+    if not _settings().get("metrics_panel"):
+        return
+    calls = _rerun_calls.get() or []
+    with st.expander(f"⏱️ Services ({len(calls)} calls, {sum(c['ms'] for c in calls):.0f} ms)"):
+        if calls:
+            st.dataframe(pd.DataFrame(calls)[["function", "ms", "rows", "bytes", "error"]],
+                         hide_index=True, use_container_width=True)
+        c1, c2 = st.columns(2)
+        c1.download_button("Prometheus", to_prometheus(), file_name="services.prom", mime="text/plain")
+        c2.download_button("JSONL", to_jsonl(), file_name="services.jsonl", mime="application/x-ndjson")
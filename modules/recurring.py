@@ -0,0 +1,293 @@
+import calendar
+import datetime
+
+# =========================================================
+# Recurring rules engine
+# ---------------------------------------------------------
+# Shared by services.check_and_process_recurring (one user, in the app) and
+# scripts/cron_job.py (every user, service key). Standard library only, so
+# the cron job does not need pandas or streamlit.
+#
+# `recurring_rules.last_run_date` is a watermark: every occurrence up to and
+# including it has been written. A run materializes each occurrence in
+# (last_run_date, today], so days or months the job did not run are caught
+# up, then moves the watermark to today. Rules that are up to date cost
+# nothing. Rules without a watermark yet get their current period.
+#
+# Generated rows carry (rule_id, period_key), which is unique in the
+# database, and are written with `on conflict do nothing`. Writing is
+# therefore idempotent: no dedupe query before the insert, and the app and
+# the cron job may run at the same moment without double-charging.
+#
+# A run costs the same few requests however many rules there are:
+#   1. one bulk upsert for every new row (per INSERT_CHUNK_SIZE rows)
+#   2. one update moving the watermarks (per INSERT_CHUNK_SIZE rules)
+#
+# `materialize` runs the same logic inside Postgres instead (the
+# materialize_recurring_expenses function in supabase_setup.sql): one RPC,
+# no rules or rows sent over the network.
+# =========================================================
+TIMEZONE = "Asia/Shanghai"
+INSERT_CHUNK_SIZE = 500
+RULES_PAGE_SIZE = 1000
+
+# Per-rule outcomes
+ADDED = "added"
+ALREADY_PAID = "already_paid"
+NOT_DUE = "not_due"
+UNSUPPORTED = "unsupported"
+
+FREQUENCIES = ("Weekly", "Monthly", "Yearly")
+
+def now(tz=TIMEZONE):
+    """
+    Current time in the app's timezone.
+    """
+    try:
+        from zoneinfo import ZoneInfo
+        return datetime.datetime.now(ZoneInfo(tz))
+    except Exception:
+        import pytz
+        return datetime.datetime.now(pytz.timezone(tz))
+
+def today(tz=TIMEZONE):
+    return now(tz).date()
+
+def _as_date(value):
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+def _month_end(year, month):
+    return datetime.date(year, month, calendar.monthrange(year, month)[1])
+
+def _on_day(year, month, target):
+    # Days past the end of a month (e.g. 31 in February) fall on its last day
+    return datetime.date(year, month, min(max(target, 1), calendar.monthrange(year, month)[1]))
+
+def supported(rule):
+    # Yearly rules need the month, taken from start_date
+    freq = rule.get("frequency", "Monthly")
+    return freq in FREQUENCIES and (freq != "Yearly" or rule.get("start_date") is not None)
+
+def period(rule, day):
+    """
+    (first, last) date of the billing period containing `day`.
+    """
+    freq = rule.get("frequency", "Monthly")
+    if freq == "Weekly":
+        start = day - datetime.timedelta(days=day.weekday())
+        return start, start + datetime.timedelta(days=6)
+    if freq == "Yearly":
+        return datetime.date(day.year, 1, 1), datetime.date(day.year, 12, 31)
+    return day.replace(day=1), _month_end(day.year, day.month)
+
+def due_date(rule, day):
+    """
+    Date the rule charges within the period containing `day`.
+    """
+    freq = rule.get("frequency", "Monthly")
+    target = int(rule.get("day", 1))
+    start, _end = period(rule, day)
+    if freq == "Weekly":
+        return start + datetime.timedelta(days=min(max(target, 0), 6))
+    if freq == "Yearly":
+        return _on_day(day.year, _as_date(rule["start_date"]).month, target)
+    return _on_day(day.year, day.month, target)
+
+def occurrences(rule, first, last):
+    """
+    Every due date of the rule with first <= date <= last, ascending.
+    Computed arithmetically per period (week / month / year index), so a
+    long gap costs one step per missed period, not per day.
+    """
+    start_date = _as_date(rule.get("start_date"))
+    if start_date is not None:
+        first = max(first, start_date)
+    if first > last:
+        return []
+    freq = rule.get("frequency", "Monthly")
+    target = int(rule.get("day", 1))
+    if freq == "Weekly":
+        offset = (min(max(target, 0), 6) - first.weekday()) % 7
+        span = (last - first).days - offset
+        if span < 0:
+            return []
+        return [first + datetime.timedelta(days=offset + 7 * k) for k in range(span // 7 + 1)]
+    if freq == "Yearly":
+        month = _as_date(rule["start_date"]).month
+        dates = (_on_day(year, month, target) for year in range(first.year, last.year + 1))
+    else:
+        months = range(first.year * 12 + first.month - 1, last.year * 12 + last.month)
+        dates = (_on_day(m // 12, m % 12 + 1, target) for m in months)
+    return [d for d in dates if first <= d <= last]
+
+def period_key(rule, due):
+    """
+    Identifies the billing period an occurrence pays, e.g. 'M:2026-10-01'
+    (frequency initial + period start). Matches the SQL backfill in
+    supabase_setup.sql.
+    """
+    return f"{rule.get('frequency', 'Monthly')[0]}:{period(rule, due)[0].isoformat()}"
+
+def next_due(rule, day):
+    """
+    Date on which the rule next has something to write, given that today is
+    `day` (may be in the past when a run is overdue). None if unsupported.
+    """
+    if not supported(rule):
+        return None
+    watermark = _as_date(rule.get("last_run_date"))
+    if watermark is None:
+        return due_date(rule, day)
+    first = watermark + datetime.timedelta(days=1)
+    start_date = _as_date(rule.get("start_date")) or first
+    dates = occurrences(rule, first, max(first, start_date) + datetime.timedelta(days=400))
+    return dates[0] if dates else None
+
+def _payload(rule, due, owner, source):
+    payload = {
+        "date": due.isoformat(),
+        "item": rule.get("name"),
+        "amount": float(rule["amount"]),
+        "category": rule.get("category"),
+        "note": f"🔄 自动订阅 ({rule.get('frequency', 'Monthly')})",
+        "source": source,
+        "rule_id": rule["id"],
+        "period_key": period_key(rule, due),
+    }
+    if owner is not None:
+        payload["user_id"] = owner
+    return payload
+
+def plan(rules, day, user_id=None, source="recurring_rule"):
+    """
+    Decides every rule in memory.
+
+    user_id:  owner for rules that do not carry one (single-user callers)
+
+    Returns (payloads to write, [(rule, outcome, due date or None)],
+    ids of rules whose watermark should move to `day`). ADDED appears once
+    per occurrence to write; see `process` for the ones that already existed.
+    """
+    payloads, outcomes, advance = [], [], []
+    for rule in rules:
+        if not supported(rule):
+            outcomes.append((rule, UNSUPPORTED, None))
+            continue
+        owner = rule.get("user_id") or user_id
+        watermark = _as_date(rule.get("last_run_date"))
+        if watermark is None:
+            # Never processed: just the current period, if already due
+            due = due_date(rule, day)
+            dues = occurrences(rule, due, due) if due <= day else []
+        else:
+            dues = occurrences(rule, watermark + datetime.timedelta(days=1), day)
+        if watermark is None or watermark < day:
+            advance.append(rule["id"])
+
+        for due in dues:
+            payloads.append(_payload(rule, due, owner, source))
+            outcomes.append((rule, ADDED, due))
+        if not dues:
+            due = due_date(rule, day)
+            outcomes.append((rule, ALREADY_PAID if due <= day else NOT_DUE, due))
+    return payloads, outcomes, advance
+
+def fetch_active_rules(supabase, user_range=None, ids=None, page_size=RULES_PAGE_SIZE):
+    """
+    Active rules, read in keyset pages on id (PostgREST caps a single
+    response at `max_rows`). Optionally limited to a [low, high) user_id
+    range (high may be None) or to the given rule ids.
+    """
+    rules, last_id = [], None
+    while True:
+        query = supabase.table("recurring_rules").select("*").eq("active", True)
+        if user_range is not None:
+            low, high = user_range
+            query = query.gte("user_id", low)
+            if high is not None:
+                query = query.lt("user_id", high)
+        if ids is not None:
+            query = query.in_("id", list(ids))
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        page = query.order("id").limit(page_size).execute().data
+        rules.extend(page)
+        if len(page) < page_size:
+            return rules
+        last_id = page[-1]["id"]
+
+def insert_all(supabase, payloads):
+    """
+    Writes the payloads, skipping periods that are already recorded.
+    Returns the (rule_id, period_key) pairs that were actually inserted.
+    """
+    inserted = set()
+    for i in range(0, len(payloads), INSERT_CHUNK_SIZE):
+        rows = supabase.table("expenses") \
+            .upsert(payloads[i:i + INSERT_CHUNK_SIZE], on_conflict="rule_id,period_key", ignore_duplicates=True) \
+            .execute().data
+        inserted.update((r.get("rule_id"), r.get("period_key")) for r in rows or [])
+    return inserted
+
+def advance_watermarks(supabase, rule_ids, day):
+    for i in range(0, len(rule_ids), INSERT_CHUNK_SIZE):
+        supabase.table("recurring_rules") \
+            .update({"last_run_date": day.isoformat()}) \
+            .in_("id", rule_ids[i:i + INSERT_CHUNK_SIZE]) \
+            .execute()
+
+def process(supabase, rules, day=None, user_id=None, source="recurring_rule"):
+    """
+    Runs the engine for `rules` (active rules, one or many users): writes
+    the missing expenses, then advances the watermarks. Returns the
+    outcomes, see `plan`.
+    """
+    day = day or today()
+    rules = list(rules or [])
+    if not rules:
+        return []
+    payloads, outcomes, advance = plan(rules, day, user_id=user_id, source=source)
+    # Rows first: if the run dies in between, the next one retries this
+    # run's occurrences (conflicts make that harmless) instead of skipping them
+    inserted = insert_all(supabase, payloads)
+    advance_watermarks(supabase, advance, day)
+    return [
+        (rule, ALREADY_PAID, due) if outcome == ADDED and (rule["id"], period_key(rule, due)) not in inserted
+        else (rule, outcome, due)
+        for rule, outcome, due in outcomes
+    ]
+
+def materialize(supabase, day=None, user_id=None, source="recurring_rule"):
+    """
+    Server-side run: one call to public.materialize_recurring_expenses.
+    Signed-in clients always get their own rules as of today; with the
+    service key, `user_id` limits the run to one user (None: everyone).
+    Returns the inserted rows ({rule_id, user_id, date, period_key}).
+    """
+    params = {"p_source": source}
+    if day is not None:
+        params["p_today"] = day.isoformat()
+    if user_id is not None:
+        params["p_user"] = user_id
+    return supabase.rpc("materialize_recurring_expenses", params).execute().data or []
+
+def outcomes_from_rows(rules, rows, day):
+    """
+    Per-rule outcomes (as returned by `process`) of a server-side run,
+    from the rules it covered and the rows it inserted.
+    """
+    inserted = {}
+    for row in rows:
+        inserted.setdefault(row["rule_id"], []).append(_as_date(row["date"]))
+    outcomes = []
+    for rule in rules:
+        if not supported(rule):
+            outcomes.append((rule, UNSUPPORTED, None))
+        elif rule["id"] in inserted:
+            outcomes.extend((rule, ADDED, due) for due in sorted(inserted[rule["id"]]))
+        else:
+            due = due_date(rule, day)
+            outcomes.append((rule, ALREADY_PAID if due <= day else NOT_DUE, due))
+    return outcomes
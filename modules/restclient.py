@@ -0,0 +1,176 @@
+import json
+import threading
+import http.client
+import urllib.parse
+
+# =========================================================
+# Minimal PostgREST client (standard library only)
+# ---------------------------------------------------------
+# Just the slice of the supabase-py query builder that modules/recurring.py
+# uses: table(...).select / insert / upsert / update / delete, the eq / gt /
+# gte / lt / lte / in_ filters, order, limit, execute, and rpc. The cron job
+# runs on it, so it needs no pip install at all (supabase-py pulls in
+# pydantic, httpx, websockets, ... and costs ~350ms just to import) and can
+# ship as a single zipapp, see scripts/build_cron.py.
+#
+# Each thread keeps one keep-alive connection, so the cron job's worker
+# threads do not redo a TLS handshake per request.
+# =========================================================
+REQUEST_TIMEOUT = 30
+
+class APIError(Exception):
+    def __init__(self, status, body):
+        try:
+            detail = json.loads(body)
+            message = detail.get("message") or body
+        except (ValueError, AttributeError):
+            detail, message = body, body
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.detail = detail
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+def _quote(value):
+    # Values inside in.(...) lists; reserved characters need double quotes
+    text = str(value)
+    if any(c in text for c in ',.:()" '):
+        return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return text
+
+class Query:
+    def __init__(self, client, table):
+        self._client = client
+        self._path = f"/{table}"
+        self._method = "GET"
+        self._params = []
+        self._body = None
+        self._prefer = []
+
+    def select(self, columns="*"):
+        self._method = "GET"
+        self._params.append(("select", columns))
+        return self
+
+    def insert(self, rows):
+        self._method, self._body = "POST", rows
+        self._prefer.append("return=representation")
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.insert(rows)
+        self._prefer.append("resolution=ignore-duplicates" if ignore_duplicates else "resolution=merge-duplicates")
+        if on_conflict:
+            self._params.append(("on_conflict", on_conflict))
+        return self
+
+    def update(self, values):
+        self._method, self._body = "PATCH", values
+        self._prefer.append("return=representation")
+        return self
+
+    def delete(self):
+        self._method = "DELETE"
+        self._prefer.append("return=representation")
+        return self
+
+    def _filter(self, column, op, value):
+        self._params.append((column, f"{op}.{value}"))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, "eq", str(value).lower() if isinstance(value, bool) else value)
+
+    def gt(self, column, value):
+        return self._filter(column, "gt", value)
+
+    def gte(self, column, value):
+        return self._filter(column, "gte", value)
+
+    def lt(self, column, value):
+        return self._filter(column, "lt", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "lte", value)
+
+    def in_(self, column, values):
+        return self._filter(column, "in", "(" + ",".join(_quote(v) for v in values) + ")")
+
+    def order(self, column, desc=False):
+        self._params.append(("order", f"{column}.{'desc' if desc else 'asc'}"))
+        return self
+
+    def limit(self, count):
+        self._params.append(("limit", str(count)))
+        return self
+
+    def execute(self):
+        return Response(self._client.request(self._method, self._path, self._params, self._body, self._prefer))
+
+class _Rpc:
+    def __init__(self, client, fn, params):
+        self._client = client
+        self._fn = fn
+        self._body = params or {}
+
+    def execute(self):
+        return Response(self._client.request("POST", f"/rpc/{self._fn}", [], self._body, []))
+
+class Client:
+    """
+    Drop-in for the supabase-py client in modules/recurring.py:
+        client = Client(SUPABASE_URL, SUPABASE_KEY)
+        client.table("recurring_rules").select("*").eq("active", True).execute().data
+    """
+    def __init__(self, url, key, timeout=REQUEST_TIMEOUT):
+        parts = urllib.parse.urlsplit(url.rstrip("/"))
+        self._https = parts.scheme == "https"
+        self._host = parts.netloc
+        self._base = parts.path + "/rest/v1"
+        self._timeout = timeout
+        self._headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        self._local = threading.local()
+
+    def table(self, name):
+        return Query(self, name)
+
+    def rpc(self, fn, params=None):
+        return _Rpc(self, fn, params)
+
+    def _connection(self, fresh=False):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or fresh:
+            if conn is not None:
+                conn.close()
+            cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            conn = self._local.conn = cls(self._host, timeout=self._timeout)
+        return conn
+
+    def request(self, method, path, params, body, prefer):
+        url = self._base + path + ("?" + urllib.parse.urlencode(params, safe="*,.:()\"") if params else "")
+        headers = dict(self._headers)
+        if prefer:
+            headers["Prefer"] = ",".join(prefer)
+        payload = json.dumps(body, default=str).encode() if body is not None else None
+        for attempt in range(2):
+            conn = self._connection(fresh=attempt > 0)
+            try:
+                conn.request(method, url, body=payload, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection: reconnect once
+                if attempt:
+                    raise
+        text = raw.decode("utf-8") if raw else ""
+        if response.status >= 400:
+            raise APIError(response.status, text)
+        return json.loads(text) if text else None
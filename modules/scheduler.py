@@ -0,0 +1,232 @@
+import time
+import heapq
+import datetime
+import threading
+import modules.recurring as recurring
+
+# =========================================================
+# In-app recurring scheduler (optional)
+# ---------------------------------------------------------
+# One daemon thread per server process keeps a heap of
+# (next_due_date, rule_id) over every active rule, sleeps until the earliest
+# one is due, and runs the recurring engine for all rules due at that point
+# in one batch. Subscriptions are then recorded on their due day instead of
+# waiting for the daily GitHub Action (which stays as a safety net: writes
+# are idempotent, see modules/recurring.py).
+#
+# It reads every user's rules, so it needs the service key. Enable it in
+# .streamlit/secrets.toml:
+#   [scheduler]
+#   enabled = true
+#   service_key = "YOUR_SUPABASE_SERVICE_ROLE_KEY"
+#
+# Rule changes made through modules/services.py call `notify`, which
+# re-reads just those rules; deleted or paused rules drop out of the heap.
+# Changes made elsewhere (another replica, the cron job, the Supabase
+# dashboard) are caught by re-reading the due rules before each run and by
+# rebuilding the whole heap every RELOAD_SECONDS.
+# =========================================================
+
+# Upper bound on one sleep, so clock changes are picked up
+MAX_SLEEP_SECONDS = 3600
+RELOAD_SECONDS = 3600
+RETRY_SECONDS = 300
+
+_instance = None
+_instance_lock = threading.Lock()
+
+class RecurringScheduler:
+    def __init__(self, supabase, on_written=None):
+        self.supabase = supabase
+        # Called with the user ids whose expenses were written
+        self.on_written = on_written
+        self._heap = []
+        self._rules = {}
+        self._generation = {}
+        self._pending = set()
+        self._reload = True
+        self._reloaded_at = 0.0
+        # Rules of users whose last run failed, retried at _retry_at
+        self._failed = set()
+        self._retry_at = 0.0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="recurring-scheduler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def notify(self, rule_ids=None):
+        """
+        Rules were created, edited or deleted. With ids, only those rules are
+        re-read; without, the whole heap is rebuilt.
+        """
+        with self._cond:
+            if rule_ids is None:
+                self._reload = True
+            else:
+                self._pending.update(int(i) for i in rule_ids)
+            self._cond.notify()
+
+    def _push(self, rule, day):
+        # Lazy deletion: an entry is live only while its generation is current
+        rule_id = rule["id"]
+        generation = self._generation.get(rule_id, 0) + 1
+        self._generation[rule_id] = generation
+        self._rules[rule_id] = rule
+        due = recurring.next_due(rule, day)
+        if due is not None:
+            heapq.heappush(self._heap, (due, rule_id, generation))
+
+    def _drop(self, rule_id):
+        self._rules.pop(rule_id, None)
+        self._generation[rule_id] = self._generation.get(rule_id, 0) + 1
+
+    def _refresh(self, day):
+        with self._cond:
+            reload, pending = self._reload, self._pending
+            self._reload, self._pending = False, set()
+        try:
+            self._apply(reload, pending, day)
+        except Exception:
+            # Keep the request for the next attempt
+            with self._cond:
+                self._reload = self._reload or reload
+                self._pending |= pending
+            raise
+
+    def _apply(self, reload, pending, day):
+        if reload:
+            rules = recurring.fetch_active_rules(self.supabase)
+            self._reloaded_at = time.monotonic()
+            self._heap, self._rules, self._generation = [], {}, {}
+            for rule in rules:
+                self._push(rule, day)
+        elif pending:
+            found = {r["id"]: r for r in recurring.fetch_active_rules(self.supabase, ids=sorted(pending))}
+            for rule_id in pending:
+                if rule_id in found:
+                    self._push(found[rule_id], day)
+                else:
+                    self._drop(rule_id)
+
+    def _pop_due(self, day):
+        due = []
+        while self._heap and self._heap[0][0] <= day:
+            _due, rule_id, generation = heapq.heappop(self._heap)
+            if self._generation.get(rule_id) == generation and rule_id in self._rules:
+                due.append(self._rules[rule_id])
+        return due
+
+    def _current(self, due):
+        """
+        Re-reads the due rules just before running them: the heap may hold
+        a stale copy if they were paused, edited or deleted outside this
+        process. Rules that are gone (or inactive) are dropped.
+        """
+        found = {r["id"]: r for r in recurring.fetch_active_rules(self.supabase, ids=[r["id"] for r in due])}
+        for rule in due:
+            if rule["id"] not in found:
+                self._drop(rule["id"])
+        return [found[r["id"]] for r in due if r["id"] in found]
+
+    def _seconds_until_next(self):
+        while self._heap and self._generation.get(self._heap[0][1]) != self._heap[0][2]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return MAX_SLEEP_SECONDS
+        current = recurring.now()
+        midnight = current.replace(hour=0, minute=0, second=0, microsecond=0)
+        due_at = midnight + datetime.timedelta(days=(self._heap[0][0] - current.date()).days)
+        seconds = (due_at - current).total_seconds()
+        return min(max(seconds, 1), MAX_SLEEP_SECONDS)
+
+    def _process(self, rules, day):
+        """
+        Runs the due rules in one engine batch. If that fails, each user is
+        retried on their own (as scripts/cron_job.py run_batch does), so one
+        tenant's bad data cannot hold back the others. Returns the rules of
+        the users that still failed.
+        """
+        try:
+            recurring.process(self.supabase, rules, day=day, source="scheduler")
+            done, failed = rules, []
+        except Exception as e:
+            print(f"订阅调度批量处理失败, 改为逐个用户处理: {e}")
+            users = {}
+            for rule in rules:
+                users.setdefault(rule.get("user_id"), []).append(rule)
+            done, failed = [], []
+            for user_id, user_rules in users.items():
+                try:
+                    recurring.process(self.supabase, user_rules, day=day, source="scheduler")
+                    done.extend(user_rules)
+                except Exception as e:
+                    print(f"订阅调度失败 (用户 {user_id}): {e}")
+                    failed.extend(user_rules)
+        for rule in done:
+            rule["last_run_date"] = day.isoformat()
+            self._push(rule, day)
+        if self.on_written and done:
+            self.on_written({rule["user_id"] for rule in done if rule.get("user_id")})
+        return failed
+
+    def _requeue_failed(self, day):
+        # Failed rules wait RETRY_SECONDS out of the heap (they would be due
+        # again at once); edits or deletes made meanwhile win
+        if not self._failed or time.monotonic() < self._retry_at:
+            return
+        for rule_id in self._failed:
+            if rule_id in self._rules:
+                self._push(self._rules[rule_id], day)
+        self._failed = set()
+
+    def _run(self):
+        while True:
+            wait = RETRY_SECONDS
+            try:
+                day = recurring.today()
+                if time.monotonic() - self._reloaded_at >= RELOAD_SECONDS:
+                    self.notify()
+                self._refresh(day)
+                self._requeue_failed(day)
+                due = self._pop_due(day)
+                if due:
+                    try:
+                        due = self._current(due)
+                    except Exception as e:
+                        print(f"订阅调度读取规则失败: {e}")
+                        failed = due
+                    else:
+                        failed = self._process(due, day) if due else []
+                    if failed:
+                        self._failed.update(rule["id"] for rule in failed)
+                        self._retry_at = time.monotonic() + RETRY_SECONDS
+                wait = self._seconds_until_next()
+                if self._failed:
+                    wait = min(wait, max(self._retry_at - time.monotonic(), 1))
+            except Exception as e:
+                print(f"订阅调度失败: {e}")
+            with self._cond:
+                if not (self._reload or self._pending):
+                    self._cond.wait(timeout=wait)
+
+def start(supabase, on_written=None):
+    """
+    Starts the process-wide scheduler once (later calls return it).
+    """
+    global _instance
+    with _instance_lock:
+        if _instance is None:
+            _instance = RecurringScheduler(supabase, on_written=on_written)
+            _instance.start()
+        return _instance
+
+def is_running():
+    return _instance is not None
+
+def notify(rule_ids=None):
+    """
+    Tells the running scheduler (if any) that rules changed.
+    """
+    if _instance is not None:
+        _instance.notify(rule_ids)
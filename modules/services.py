@@ -1,98 +1,613 @@
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import streamlit as st
 import datetime
+import modules.cache as cache
+import modules.ledger as ledger
+import modules.snapshot as snapshot
+import modules.metrics as metrics
+import modules.analytics as analytics
+import modules.recurring as recurring
+import modules.scheduler as scheduler
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    add_script_run_ctx = get_script_run_ctx = None
 
 # Categories constant (can be imported by UI)
-CATEGORIES = ["餐饮", "日用品", "交通", "服饰", "医疗", "娱乐", "居住", "其他"]
+CATEGORIES = ledger.CATEGORIES
+
+# --- Read Cache ---
+# Reads are cached per user and per table version. Any write through this
+# module bumps the version of the table it touched, so the next read misses,
+# and evicts that user's entries for the table (full-history frames are big).
+# The TTL only bounds staleness for writes made elsewhere (cron job, other devices).
+CACHE_TTL_SECONDS = 300
+CACHE_MAX_ENTRIES = 256
+
+_read_cache = cache.TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+_versions = cache.DataVersions(cache=_read_cache)
+
+def _cache_owner(supabase):
+    """
+    Identifies whose data a client reads. RLS scopes every query to the
+    logged-in user, so the user id is the natural partition key.
+    """
+    try:
+        user = st.session_state.get("user")
+    except Exception:
+        user = None
+    if user is not None and getattr(user, "id", None):
+        return str(user.id)
+    return f"client:{id(supabase)}"
+
+def _invalidate(supabase, table):
+    _versions.bump(_cache_owner(supabase), table)
+
+def note_external_write(owners, *tables):
+    """
+    Invalidates the given users' cached reads after a write made outside
+    their session (e.g. by the in-app scheduler).
+    """
+    for owner in owners:
+        for table in tables:
+            _versions.bump(str(owner), table)
+
+def _read_key(name, owner, version, args, kwargs):
+    return (name, owner, version, args, tuple(sorted(kwargs.items())))
+
+# --- Per-rerun Memo ---
+# Several widgets of one page ask for the same data (the KPI header, budget
+# cards and editors all read budgets). Within one script run every read is
+# answered from a memo in session_state, even if the shared cache entry
+# expires or is evicted meanwhile. Keys carry the table version, so a write
+# during the run makes the next read miss as it should.
+_RERUN_MEMO_KEY = "_services_rerun_reads"
+
+def begin_rerun():
+    """
+    Starts a fresh per-rerun memo. Called once at the top of each script run.
+    """
+    try:
+        st.session_state[_RERUN_MEMO_KEY] = {}
+    except Exception:
+        pass
+
+def _rerun_memo():
+    try:
+        return st.session_state.get(_RERUN_MEMO_KEY)
+    except Exception:
+        # Background threads have no script run
+        return None
+
+# Concurrent misses on the same key (e.g. from the dashboard bundle) wait for
+# one request instead of each issuing their own.
+_inflight_guard = threading.Lock()
+_inflight = {}
+
+def _inflight_lock(key):
+    with _inflight_guard:
+        return _inflight.setdefault(key, threading.Lock())
+
+def cached_read(table, default=None):
+    """
+    Decorator for read functions. Caches the result under
+    (function, user, table version, arguments), and memoizes it for the
+    current rerun. Failures are logged and return `default()` without being cached.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(supabase, *args, **kwargs):
+            owner = _cache_owner(supabase)
+            key = _read_key(fn.__name__, owner, _versions.get(owner, table), args, kwargs)
+            memo = _rerun_memo()
+            if memo is not None and key in memo:
+                return memo[key]
+            value = _read_cache.get(key)
+            if cache.is_missing(value):
+                with _inflight_lock(key):
+                    value = _read_cache.get(key)
+                    if cache.is_missing(value):
+                        try:
+                            value = fn(supabase, *args, **kwargs)
+                        except Exception as e:
+                            print(f"{fn.__name__} 失败: {e}")
+                            metrics.note_error()
+                            return default() if default else None
+                        else:
+                            _read_cache.set(key, value, tags=[(owner, table)])
+                        finally:
+                            with _inflight_guard:
+                                _inflight.pop(key, None)
+            if memo is not None:
+                memo[key] = value
+            return value
+        return wrapper
+    return decorator
+
+def clear_cache():
+    """
+    Drops every cached read (all users). Mostly useful for debugging.
+    """
+    _read_cache.clear()
+
+# --- Incremental Sync ---
+# The cleaned expense frame of each user is kept between cache misses.
+# A refresh only asks for rows whose `updated_at` moved past the watermark
+# (inserts and edits), then compares the row count to pick up deletes.
+# Rows are re-read with a small overlap so a commit that lands slightly
+# after its timestamp is not missed; merging by id makes that harmless.
+SYNC_OVERLAP_SECONDS = 5
+
+# History is read in pages of this many rows (PostgREST caps a single
+# response at `max_rows`, 1000 by default on Supabase).
+EXPENSE_PAGE_SIZE = 500
+
+_sync_states = cache.TTLCache(maxsize=64, ttl=3600)
+
+@metrics.instrument
+@cached_read("expenses", default=ledger.empty)
+def load_expenses(supabase, limit=None):
+    """
+    Loads the newest `limit` expenses from Supabase (full history when None).
+    Returns the canonical frame described in modules/ledger.py. The result is
+    shared through the read cache, so callers must copy before mutating it.
+    """
+    owner = _cache_owner(supabase)
+    key = (owner, limit)
+    state = _sync_states.get(key, None)
 
-def load_expenses(supabase, limit=500):
+    # Cold start: paint from the on-disk snapshot and reconcile in the background
+    if state is None and limit is None and _snapshot_owner(owner):
+        snap = snapshot.load(owner)
+        if snap is not None and snap["updated_at"].notna().any():
+            state = {"frame": snap, "watermark": snap["updated_at"].max()}
+            _sync_states.set(key, state)
+            threading.Thread(target=_reconcile_snapshot, args=(supabase, owner, state), daemon=True).start()
+            return snap
+
+    df = None
+    if state is not None:
+        try:
+            df = _sync_expenses(supabase, state, limit)
+        except Exception as e:
+            print(f"增量同步失败, 改为全量加载: {e}")
+    if df is None:
+        df = ledger.from_rows(_fetch_expense_rows(supabase, limit))
+    # Lets consumers tell "no older rows exist" from "older rows not loaded"
+    df.attrs["complete"] = limit is None
+
+    if df["updated_at"].notna().any():
+        new_state = {"frame": df, "watermark": df["updated_at"].max()}
+        _sync_states.set(key, new_state)
+        if limit is None and _snapshot_owner(owner) and _state_changed(state, new_state):
+            threading.Thread(target=snapshot.save, args=(owner, df), daemon=True).start()
+    return df
+
+def _snapshot_owner(owner):
+    # Only real users get a snapshot (not anonymous clients)
+    return snapshot.ENABLED and not owner.startswith("client:")
+
+def _state_changed(old, new):
+    if old is None:
+        return True
+    return len(old["frame"]) != len(new["frame"]) or old["watermark"] != new["watermark"]
+
+def _reconcile_snapshot(supabase, owner, state):
     """
-    Loads expenses from Supabase.
-    Returns a cleaned DataFrame.
+    Background half of the cold start: sync the snapshot frame with Supabase,
+    then publish the result as the next cache version so the following rerun
+    picks it up without another request.
     """
+    version = _versions.get(owner, "expenses")
     try:
+        df = _sync_expenses(supabase, state, None)
+    except Exception as e:
+        # Keep serving the snapshot; the next cache miss retries in the foreground
+        print(f"快照同步失败: {e}")
+        return
+    df.attrs["complete"] = True
+    new_state = {"frame": df, "watermark": df["updated_at"].max()}
+    # A write happened meanwhile: its own invalidation already forces a sync
+    if _versions.get(owner, "expenses") != version:
+        return
+    _sync_states.set((owner, None), new_state)
+    if _state_changed(state, new_state):
+        version = _versions.bump(owner, "expenses")
+        _read_cache.set(_read_key("load_expenses", owner, version, (), {}), df, tags=[(owner, "expenses")])
+        snapshot.save(owner, df)
+
+def iter_expenses(supabase, page_size=EXPENSE_PAGE_SIZE, since=None):
+    """
+    Streams expenses newest first as canonical DataFrame chunks of at most
+    `page_size` rows. Stop iterating to read only recent records; consume it
+    fully for the whole history. `since` (YYYY-MM-DD) bounds the oldest date.
+    """
+    for rows in _iter_expense_pages(supabase, "*", page_size, since):
+        yield ledger.from_rows(rows)
+
+@metrics.instrument
+@cached_read("expenses", default=ledger.empty)
+def get_recent_expenses(supabase, count=20):
+    """
+    The newest `count` expenses (canonical frame). Reads only the first page
+    of iter_expenses instead of sorting the full history.
+    """
+    return next(iter_expenses(supabase, page_size=count), ledger.empty())
+
+def _iter_expense_pages(supabase, columns, page_size, since=None):
+    """
+    Keyset pagination on (date, id) descending: each page continues strictly
+    after the last row of the previous one, so deep pages cost the same as
+    the first and concurrent inserts never shift rows between pages.
+    """
+    cursor = None
+    while True:
         # Supabase RLS automatically filters by user_id if set up correctly
-        response = supabase.table("expenses").select("*").order("date", desc=True).order("id", desc=True).limit(limit).execute()
-        rows = response.data
-        
+        query = supabase.table("expenses").select(columns)
+        if since:
+            query = query.gte("date", str(since))
+        if cursor is not None:
+            last_date, last_id = cursor
+            query = query.or_(f"date.lt.{last_date},and(date.eq.{last_date},id.lt.{last_id})")
+        rows = query.order("date", desc=True).order("id", desc=True).limit(page_size).execute().data
         if not rows:
-            return pd.DataFrame()
-            
-        df = pd.DataFrame(rows)
-        
-        # Data Cleaning
-        if "amount" in df.columns:
-            df["有效金额"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0)
-        
-        if "date" in df.columns:
-            df["日期"] = pd.to_datetime(df["date"], errors="coerce")
-            df["月(yyyy-mm)"] = df["日期"].dt.strftime("%Y-%m")
-            df["年"] = df["日期"].dt.year
-            
-        if "category" in df.columns:
-            # Map legacy English categories to Chinese
-            cat_map = {
-                "Dining": "餐饮", "Food": "餐饮", 
-                "Transport": "交通", "Transportation": "交通",
-                "Shopping": "日用品", "Daily": "日用品",
-                "Housing": "居住", "Home": "居住",
-                "Medical": "医疗", "Health": "医疗",
-                "Entertainment": "娱乐", "Fun": "娱乐",
-                "Clothing": "服饰",
-                "Others": "其他", "Other": "其他", "General": "其他"
-            }
-            # Apply map, keep original if not in map
-            df["分类"] = df["category"].replace(cat_map)
-            
-            # Ensure all values are within the allowed list, otherwise default to "其他"
-            allowed = set(CATEGORIES)
-            df["分类"] = df["分类"].apply(lambda x: x if x in allowed else "其他")
-            
-        df["项目"] = df.get("item", "")
-        df["备注"] = df.get("note", "")
-        df["金额"] = df.get("amount", 0)
-        df["来源"] = df.get("source", "")
-        
-        return df   
-        
-    except Exception as e:
-        print(f"数据加载失败: {e}")
-        return pd.DataFrame()
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        cursor = (rows[-1]["date"], rows[-1]["id"])
+
+def _fetch_expense_rows(supabase, limit, columns="*"):
+    """
+    Collects the newest `limit` raw rows (all rows when None) page by page.
+    """
+    page_size = min(limit, EXPENSE_PAGE_SIZE) if limit else EXPENSE_PAGE_SIZE
+    rows = []
+    for page in _iter_expense_pages(supabase, columns, page_size):
+        rows.extend(page)
+        if limit and len(rows) >= limit:
+            return rows[:limit]
+    return rows
+
+def _iter_changed_pages(supabase, since, page_size):
+    """
+    Rows with updated_at >= `since`, in keyset pages on (updated_at, id)
+    ascending. Reading stops only at a short page, so the caller's new
+    watermark never skips rows of a change set larger than one response.
+    """
+    cursor = None
+    while True:
+        query = supabase.table("expenses").select("*").gte("updated_at", since)
+        if cursor is not None:
+            last_ts, last_id = cursor
+            # Timestamps contain reserved characters (':', '.'), hence the quotes
+            query = query.or_(f'updated_at.gt."{last_ts}",and(updated_at.eq."{last_ts}",id.gt.{last_id})')
+        rows = query.order("updated_at").order("id").limit(page_size).execute().data
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        cursor = (rows[-1]["updated_at"], rows[-1]["id"])
+
+def _sync_expenses(supabase, state, limit):
+    """
+    Brings a previously loaded frame up to date.
+    Costs two small requests when nothing changed.
+    """
+    df = state["frame"]
+    since = state["watermark"] - pd.Timedelta(seconds=SYNC_OVERLAP_SECONDS)
+
+    # 1. Inserts and updates (every page: a bulk edit can exceed `max_rows`)
+    changed = [row for page in _iter_changed_pages(supabase, since.isoformat(), EXPENSE_PAGE_SIZE) for row in page]
+    if changed:
+        fresh = ledger.from_rows(changed)
+        df = ledger.concat([df[~df["id"].isin(fresh["id"])], fresh])
+        df = df.sort_values(["date", "id"], ascending=[False, False])
+        if limit:
+            df = df.head(limit)
+        df = df.reset_index(drop=True)
+
+    # 2. Deletes: only resolved when the server row count disagrees
+    total = supabase.table("expenses").select("id", count="exact").limit(1).execute().count or 0
+    if len(df) != (min(total, limit) if limit else total):
+        live_ids = [r["id"] for r in _fetch_expense_rows(supabase, limit, columns="id,date")]
+        df = df[df["id"].isin(live_ids)]
+        # Older rows that slid into the window after a delete
+        missing = list(set(live_ids) - set(df["id"]))
+        if missing:
+            extra = ledger.from_rows(supabase.table("expenses").select("*").in_("id", missing).execute().data)
+            df = ledger.concat([df, extra])
+        df = df.sort_values(["date", "id"], ascending=[False, False]).reset_index(drop=True)
+    return df
+
+# --- Server-side Aggregates ---
+# Thin wrappers around the SQL functions in supabase_setup.sql. Each returns a
+# small frame (one row per month / category / day) instead of raw expenses,
+# or None when the RPC is unavailable so callers can aggregate locally.
+
+# PostgREST / Postgres error codes for a function or table that does not exist
+_MISSING_OBJECT_CODES = ("PGRST202", "PGRST205", "42P01", "42883")
+# Server-side objects found missing; not asked for again until the app restarts
+_missing_objects = set()
+
+def _server_object(name):
+    """
+    Decorator for reads backed by an optional object of supabase_setup.sql.
+    Once the object turns out to be missing, the read returns None without
+    a request (projects that have not run the SQL go straight to the local
+    computation). Other errors propagate as usual.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if name in _missing_objects:
+                return None
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                code = getattr(e, "code", None)
+                if code not in _MISSING_OBJECT_CODES and not any(c in str(e) for c in _MISSING_OBJECT_CODES):
+                    raise
+                _missing_objects.add(name)
+                print(f"{name} 未安装 (见 supabase_setup.sql), 改用本地计算")
+                return None
+        return wrapper
+    return decorator
+
+@metrics.instrument
+@cached_read("expenses")
+@_server_object("expense_monthly_totals")
+def get_monthly_totals(supabase):
+    """
+    Per-month totals over the whole history.
+    Columns: month (YYYY-MM), total, count.
+    """
+    rows = supabase.rpc("expense_monthly_totals", {}).execute().data
+    df = pd.DataFrame(rows or [], columns=["month", "total", "count"])
+    df["total"] = pd.to_numeric(df["total"], errors="coerce").fillna(0)
+    return df
+
+@metrics.instrument
+@cached_read("expenses")
+@_server_object("expense_category_totals")
+def get_category_totals(supabase, start_date=None, end_date=None):
+    """
+    Per-category totals between two dates (inclusive, open-ended when None).
+    Legacy category names are folded into CATEGORIES.
+    Columns: category, total, count.
+    """
+    params = {
+        "p_start": str(start_date) if start_date else None,
+        "p_end": str(end_date) if end_date else None,
+    }
+    rows = supabase.rpc("expense_category_totals", params).execute().data
+    df = pd.DataFrame(rows or [], columns=["category", "total", "count"])
+    df["total"] = pd.to_numeric(df["total"], errors="coerce").fillna(0)
+    df["category"] = ledger.normalize_categories(df["category"])
+    return df.groupby("category", as_index=False, observed=True)[["total", "count"]].sum()
+
+@metrics.instrument
+@cached_read("expenses")
+@_server_object("expense_daily_totals")
+def get_daily_totals(supabase, start_date, end_date):
+    """
+    Per-day totals between two dates (inclusive). Days without spending are absent.
+    Columns: day (datetime), total, count.
+    """
+    params = {"p_start": str(start_date), "p_end": str(end_date)}
+    rows = supabase.rpc("expense_daily_totals", params).execute().data
+    df = pd.DataFrame(rows or [], columns=["day", "total", "count"])
+    df["day"] = pd.to_datetime(df["day"])
+    df["total"] = pd.to_numeric(df["total"], errors="coerce").fillna(0)
+    return df
+
+@metrics.instrument
+@cached_read("expenses")
+@_server_object("monthly_category_totals")
+def get_month_summary(supabase, month):
+    """
+    Per-category totals of one month (yyyymm code, see ledger.month_code)
+    from the trigger-maintained monthly_category_totals table: a few rows,
+    whatever the size of the ledger. None when the table is not installed.
+    Columns: category, total, count.
+    """
+    rows = supabase.table("monthly_category_totals") \
+        .select("category, total, count") \
+        .eq("month", f"{ledger.month_label(month)}-01") \
+        .execute().data
+    df = pd.DataFrame(rows or [], columns=["category", "total", "count"])
+    df["total"] = pd.to_numeric(df["total"], errors="coerce").fillna(0)
+    df["count"] = pd.to_numeric(df["count"], errors="coerce").fillna(0).astype("int64")
+    df["category"] = ledger.normalize_categories(df["category"])
+    return df.groupby("category", as_index=False, observed=True)[["total", "count"]].sum()
+
+@metrics.instrument
+def get_month_snapshot(supabase, df):
+    """
+    analytics.MonthSnapshot of the current month (Asia/Shanghai) for the KPI
+    header and budget cards. `df` is the frame from load_expenses; it is only
+    scanned when the monthly summary table is unavailable.
+    Cached per user under the versions of all three source tables and the day.
+    """
+    import pytz
+    now = pd.Timestamp.now(tz=pytz.timezone("Asia/Shanghai"))
+    owner = _cache_owner(supabase)
+    versions = tuple(_versions.get(owner, t) for t in ("expenses", "budgets", "recurring_rules"))
+    key = _read_key("get_month_snapshot", owner, versions, (now.strftime("%Y-%m-%d"),), {})
+    memo = _rerun_memo()
+    if memo is not None and key in memo:
+        return memo[key]
+    snap = _read_cache.get(key)
+    if cache.is_missing(snap):
+        snap = analytics.compute_month_snapshot(
+            df, get_budgets(supabase), get_recurring_rules(supabase), now,
+            category_totals=get_month_summary(supabase, ledger.month_code(now)),
+        )
+        _read_cache.set(key, snap, tags=[(owner, t) for t in ("expenses", "budgets", "recurring_rules")])
+    if memo is not None:
+        memo[key] = snap
+    return snap
 
-def get_daily_activity(supabase, days=180):
+@metrics.instrument
+def get_daily_activity(supabase, days=180, df=None):
     """
-    Get daily transaction counts for heatmap.
+    Daily spending totals for the heatmap as a dense float array of length
+    days + 1. Index i is the day `today - days + i` (Asia/Shanghai), so the
+    last element is today.
+    Reuses `df` (the frame from load_expenses) when it covers the window,
+    otherwise asks the server for per-day sums.
     """
+    import pytz
+    tz = pytz.timezone("Asia/Shanghai")
+    end_date = datetime.datetime.now(tz).date()
+    start_date = end_date - datetime.timedelta(days=days)
+
+    if df is not None and _frame_covers(df, start_date):
+        if df.empty:
+            return np.zeros(days + 1)
+        return _bin_by_day(df["date"], ledger.money(df["amount_cents"]), start_date, days)
+
+    totals = get_daily_totals(supabase, start_date, end_date)
+    if totals is not None:
+        return _bin_by_day(totals["day"], totals["total"], start_date, days)
+
+    # Aggregation RPC not installed: group the raw rows locally
     try:
-        import pytz
-        tz = pytz.timezone("Asia/Shanghai")
-        end_date = datetime.datetime.now(tz).date()
-        start_date = end_date - datetime.timedelta(days=days)
-        
-        response = supabase.table("expenses") \
+        rows = supabase.table("expenses") \
             .select("date, amount") \
             .gte("date", start_date.strftime("%Y-%m-%d")) \
             .lte("date", end_date.strftime("%Y-%m-%d")) \
-            .execute()
-            
-        if not response.data:
-            return {}
-            
-        # Sum amounts
-        counts = {}
-        for row in response.data:
-            d = row["date"]
-            try:
-                amt = float(row.get("amount", 0) or 0)
-            except:
-                amt = 0
-            counts[d] = counts.get(d, 0) + amt
-            
-        return counts
+            .execute().data
     except Exception as e:
         print(f"Error fetching activity: {e}")
-        return {}
+        rows = []
+    raw = pd.DataFrame(rows or [], columns=["date", "amount"])
+    return _bin_by_day(pd.to_datetime(raw["date"], errors="coerce"), pd.to_numeric(raw["amount"], errors="coerce"), start_date, days)
+
+def _frame_covers(df, start_date):
+    """
+    True when the loaded frame holds every expense on or after `start_date`.
+    """
+    if df.empty:
+        return bool(df.attrs.get("complete"))
+    return bool(df.attrs.get("complete")) or df["date"].min() <= pd.Timestamp(start_date)
+
+def _bin_by_day(dates, amounts, start_date, days):
+    offsets = (pd.to_datetime(dates).dt.normalize() - pd.Timestamp(start_date)).dt.days.to_numpy(dtype=float)
+    weights = pd.to_numeric(amounts, errors="coerce").fillna(0).to_numpy(dtype=float)
+    mask = ~np.isnan(offsets) & (offsets >= 0) & (offsets <= days)
+    return np.bincount(offsets[mask].astype(np.int64), weights=weights[mask], minlength=days + 1)
+
+# --- Dashboard Bundle ---
+# Every page starts with the same independent reads (ledger, budgets,
+# subscriptions). Issuing them concurrently makes a cold rerun cost roughly
+# the slowest query instead of the sum of all of them. Results land in the
+# read cache, so the renderers' own get_* calls afterwards are free.
+BUNDLE_WORKERS = 4
+
+def _run_concurrently(calls):
+    """
+    Runs {name: (fn, args)} on a small thread pool and returns {name: result}.
+    Worker threads are attached to the current Streamlit script run so that
+    st.session_state (used for the cache owner) behaves as on the main thread.
+    """
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
+
+    def attach():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    with ThreadPoolExecutor(max_workers=min(BUNDLE_WORKERS, len(calls)), initializer=attach) as pool:
+        # Each task runs in a copy of the caller's context (metrics page/call)
+        futures = {name: pool.submit(contextvars.copy_context().run, fn, *args) for name, (fn, args) in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+@metrics.instrument
+def load_dashboard_bundle(supabase):
+    """
+    Fetches everything the page renderers need in one concurrent round:
+    {"expenses": frame, "budgets": [...], "rules": [...]}.
+    The heatmap needs no request of its own; get_daily_activity bins the
+    full-history frame locally.
+    """
+    return _run_concurrently({
+        "expenses": (load_expenses, (supabase,)),
+        "budgets": (get_budgets, (supabase,)),
+        "rules": (get_recurring_rules, (supabase,)),
+    })
 
+# --- Batched Writes ---
+# Editors save many rows at once through apply_changes, the single batched
+# write path. Its helpers cost one request per BATCH_CHUNK_SIZE rows (an `in`
+# filter for deletes, one payload for upserts) instead of one request per row.
+BATCH_CHUNK_SIZE = 500
+
+def _chunks(items, size=BATCH_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _plain(value):
+    # numpy scalars, NaN/NA and dates (from DataFrames) are not JSON serialisable
+    if value is None or value is pd.NA or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    return value.item() if hasattr(value, "item") else value
+
+def _delete_many(supabase, table, ids):
+    ids = [int(i) for i in ids if i is not None and i == i]
+    for chunk in _chunks(ids):
+        supabase.table(table).delete().in_("id", chunk).execute()
+    if ids:
+        _invalidate(supabase, table)
+
+def _upsert_many(supabase, table, rows):
+    """
+    Rows must all carry the same keys (PostgREST requirement for bulk payloads);
+    rows with an `id` update that row, rows without one are inserted.
+    """
+    rows = [{k: _plain(v) for k, v in r.items()} for r in rows]
+    with_id = [r for r in rows if r.get("id") is not None]
+    without_id = [{k: v for k, v in r.items() if k != "id"} for r in rows if r.get("id") is None]
+    for r in with_id:
+        r["id"] = int(r["id"])
+    for group in (with_id, without_id):
+        for chunk in _chunks(group):
+            supabase.table(table).upsert(chunk).execute()
+    if rows:
+        _invalidate(supabase, table)
+
+@metrics.instrument
+def apply_changes(supabase, table, changes):
+    """
+    Persists a modules.changeset.ChangeSet: one delete, one upsert for the
+    modified rows and one insert for new rows (per BATCH_CHUNK_SIZE rows).
+    Unchanged rows never reach the network.
+    """
+    if changes.is_empty():
+        return True
+    try:
+        _delete_many(supabase, table, changes.deletes)
+        _upsert_many(supabase, table, changes.update_rows)
+        _upsert_many(supabase, table, changes.inserts)
+        if table == "recurring_rules":
+            # New rows have no id yet: rebuild the schedule in that case
+            scheduler.notify(None if changes.inserts else list(changes.deletes) + [u[changes.key] for u in changes.updates])
+        return True
+    except Exception as e:
+        print(f"保存失败: {e}")
+        _invalidate(supabase, table)
+        return False
+
+@metrics.instrument
+def add_expense(supabase, user_id, date, item, amount, category="其他", note="", source="manual"):
     """
     Adds a single expense record.
     """
@@ -107,10 +622,12 @@ def get_daily_activity(supabase, days=180):
             "user_id": user_id
         }
         supabase.table("expenses").insert(payload).execute()
+        _invalidate(supabase, "expenses")
         return True, "Success"
     except Exception as e:
         return False, str(e)
 
+@metrics.instrument
 def add_expenses_batch(supabase, payloads):
     """
     Adds multiple expense records.
@@ -118,31 +635,36 @@ def add_expenses_batch(supabase, payloads):
     try:
         if payloads:
             supabase.table("expenses").insert(payloads).execute()
+            _invalidate(supabase, "expenses")
         return True, "Success"
     except Exception as e:
         return False, str(e)
 
+@metrics.instrument
 def delete_expense(supabase, expense_id):
     try:
         supabase.table("expenses").delete().eq("id", expense_id).execute()
+        _invalidate(supabase, "expenses")
         return True, "Success"
     except Exception as e:
         return False, str(e)
 
+@metrics.instrument
 def update_expense(supabase, expense_id, updates):
     try:
         supabase.table("expenses").update(updates).eq("id", expense_id).execute()
+        _invalidate(supabase, "expenses")
         return True, "Success"
     except Exception as e:
         return False, str(e)
 
+@metrics.instrument
+@cached_read("budgets", default=list)
 def get_budgets(supabase):
-    try:
-        response = supabase.table("budgets").select("*").execute()
-        return response.data
-    except:
-        return []
+    response = supabase.table("budgets").select("*").execute()
+    return response.data
 
+@metrics.instrument
 def add_budget(supabase, user_id, name, category, amount, color, icon):
     try:
         payload = {
@@ -154,32 +676,37 @@ def add_budget(supabase, user_id, name, category, amount, color, icon):
             "user_id": user_id
         }
         supabase.table("budgets").insert(payload).execute()
+        _invalidate(supabase, "budgets")
         return True
     except Exception as e:
         print(f"添加失败: {e}")
         return False
 
+@metrics.instrument
 def delete_budget(supabase, bid):
     try:
         supabase.table("budgets").delete().eq("id", bid).execute()
+        _invalidate(supabase, "budgets")
         return True
     except:
         return False
 
+@metrics.instrument
 def update_budget(supabase, bid, updates):
     try:
         supabase.table("budgets").update(updates).eq("id", bid).execute()
+        _invalidate(supabase, "budgets")
         return True
     except:
         return False
 
+@metrics.instrument
+@cached_read("recurring_rules", default=list)
 def get_recurring_rules(supabase):
-    try:
-        response = supabase.table("recurring_rules").select("*").eq("active", True).execute()
-        return response.data
-    except:
-        return []
+    response = supabase.table("recurring_rules").select("*").eq("active", True).execute()
+    return response.data
 
+@metrics.instrument
 def add_recurring(supabase, user_id, name, amount, category, frequency, start_date):
     """
     Adds a recurring rule.
@@ -197,121 +724,129 @@ def add_recurring(supabase, user_id, name, amount, category, frequency, start_da
         "active": True,
         "user_id": user_id
     }
-    supabase.table("recurring_rules").insert(payload).execute()
+    if start_date is not None:
+        payload["start_date"] = str(start_date)
+    rows = supabase.table("recurring_rules").insert(payload).execute().data
+    _invalidate(supabase, "recurring_rules")
+    scheduler.notify([r["id"] for r in rows or []])
 
+@metrics.instrument
 def delete_recurring(supabase, rid):
     try:
         supabase.table("recurring_rules").delete().eq("id", rid).execute()
+        _invalidate(supabase, "recurring_rules")
+        scheduler.notify([rid])
         return True
     except:
         return False
 
+@metrics.instrument
 def update_recurring(supabase, rid, updates):
     try:
         supabase.table("recurring_rules").update(updates).eq("id", rid).execute()
+        _invalidate(supabase, "recurring_rules")
+        scheduler.notify([rid])
         return True
     except:
         return False
 
+# Rows read per round of migrate_legacy_categories (below PostgREST's max_rows)
+MIGRATION_SAMPLE_SIZE = 1000
+
+@metrics.instrument
+def migrate_legacy_categories(supabase, tables=("expenses", "budgets", "recurring_rules"), dry_run=False):
+    """
+    One-off rewrite of legacy category values ("Dining", "Transport", ...)
+    into CATEGORIES. Reads a bounded sample of non-canonical rows, issues one
+    UPDATE per target category using an `in` filter on the old values, and
+    repeats while new legacy values turn up. Each round excludes the values
+    already seen, so the cost follows the number of distinct legacy values,
+    not the row count, and no value hides behind PostgREST's `max_rows`.
+    With a user session this migrates that user's rows (RLS); with the
+    service key it migrates every user.
+    Returns {table: {target: [old values]}}.
+    SQL equivalent: supabase_migrate_categories.sql
+    """
+    report = {}
+    for table in tables:
+        targets, seen = {}, list(CATEGORIES)
+        while True:
+            rows = supabase.table(table).select("category") \
+                .not_.in_("category", seen) \
+                .limit(MIGRATION_SAMPLE_SIZE) \
+                .execute().data
+            found = ledger.legacy_targets([r["category"] for r in rows])
+            if not found:
+                break
+            for target, old_values in found.items():
+                if not dry_run:
+                    supabase.table(table).update({"category": target}).in_("category", old_values).execute()
+                targets.setdefault(target, []).extend(old_values)
+                seen.extend(old_values)
+        if not targets:
+            continue
+        report[table] = targets
+        if not dry_run:
+            _invalidate(supabase, table)
+    return report
+
+def _server_side_recurring():
+    # [recurring] server_side = true: materialize inside Postgres (one RPC)
+    try:
+        return bool(st.secrets.get("recurring", {}).get("server_side"))
+    except Exception:
+        return False
+
+@metrics.instrument
 def check_and_process_recurring(supabase, user_id):
+    """
+    Records this period's charge for every due subscription of the user.
+    See modules/recurring.py: one idempotent bulk upsert per run, or a
+    single RPC when the server-side function is enabled.
+    """
     try:
-        import pytz
-        tz = pytz.timezone("Asia/Shanghai")
-        
         rules = get_recurring_rules(supabase)
         if not rules:
             return "没有发现活跃的订阅规则。"
-        
-        today = pd.Timestamp.now(tz=tz)
-        current_day = today.day
-        current_weekday = today.weekday() # 0=Mon
-        current_month_str = today.strftime("%Y-%m")
-        
-        count_added = 0
-        details = []
-
-        for rule in rules:
+
+        if _server_side_recurring():
+            day = recurring.today()
+            rows = recurring.materialize(supabase, source="recurring_rule")
+            outcomes = recurring.outcomes_from_rows(rules, rows, day)
+        else:
+            outcomes = recurring.process(supabase, rules, user_id=user_id, source="recurring_rule")
+        added = [rule for rule, outcome, _due in outcomes if outcome == recurring.ADDED]
+        if added:
+            _invalidate(supabase, "expenses")
+        # Watermarks (last_run_date) moved
+        _invalidate(supabase, "recurring_rules")
+
+        details, warnings = [], []
+        for rule, outcome, due in outcomes:
             rule_name = rule.get("name")
-            target_day = int(rule.get("day", 1))
-            freq = rule.get("frequency", "Monthly")
-            
-            should_process = False
-            start_date_check = ""
-            end_date_check = ""
-            
-            # --- LOGIC SELECTION ---
-            if freq == "Weekly":
-                # Check period: Monday of this week to Sunday of this week
-                start_of_week = today - pd.Timedelta(days=today.weekday())
-                end_of_week = start_of_week + pd.Timedelta(days=6)
-                
-                start_date_check = start_of_week.strftime("%Y-%m-%d")
-                end_date_check = end_of_week.strftime("%Y-%m-%d")
-                
-                # If today's weekday >= target weekday, it might be due
-                if current_weekday >= target_day:
-                    should_process = True
-                else:
-                    details.append(f"⏳ 跳过 (未到周{target_day+1}): {rule_name}")
-
-            elif freq == "Yearly":
-                 pass # Not fully implemented
-
-            else: # Default Monthly
-                # Check period: Start of Month to End of Month
-                start_date_check = f"{current_month_str}-01"
-                last_day = pd.Timestamp(today.year, today.month, 1) + pd.offsets.MonthEnd(0)
-                end_date_check = last_day.strftime("%Y-%m-%d")
-                
-                if current_day >= target_day:
-                    should_process = True
+            if outcome == recurring.ADDED:
+                details.append(f"✅ 添加成功: {rule_name} ({due})")
+            elif outcome == recurring.ALREADY_PAID:
+                details.append(f"⏭️ 跳过 (本期已付): {rule_name}")
+            elif outcome == recurring.NOT_DUE:
+                if rule.get("frequency") == "Weekly":
+                    details.append(f"⏳ 跳过 (未到周{due.weekday() + 1}): {rule_name}")
                 else:
-                    details.append(f"⏳ 跳过 (未到{target_day}号): {rule_name}")
-            
-            # --- EXECUTION ---
-            if should_process:
-                # Check duplicates
-                res = supabase.table("expenses") \
-                    .select("*") \
-                    .eq("item", rule_name) \
-                    .eq("category", rule["category"]) \
-                    .gte("date", start_date_check) \
-                    .lte("date", end_date_check) \
-                    .execute()
-                
-                if not res.data:
-                    # Calculate due date
-                    due_date = today # Default to today
-                    
-                    if freq == "Monthly":
-                        try:
-                            due_date = pd.Timestamp(year=today.year, month=today.month, day=target_day)
-                        except: # Invalid day (e.g. 31 in Feb)
-                            due_date = pd.Timestamp(year=today.year, month=today.month, day=1) + pd.offsets.MonthEnd(0)
-                    elif freq == "Weekly":
-                        start_of_week = today - pd.Timedelta(days=today.weekday())
-                        due_date = start_of_week + pd.Timedelta(days=target_day)
-
-                    payload = {
-                        "date": due_date.strftime("%Y-%m-%d"),
-                        "item": rule_name,
-                        "amount": float(rule["amount"]),
-                        "category": rule["category"],
-                        "note": f"🔄 自动订阅 ({freq})",
-                        "source": "recurring_rule",
-                        "user_id": user_id
-                    }
-                    supabase.table("expenses").insert(payload).execute()
-                    count_added += 1
-                    details.append(f"✅ 添加成功: {rule_name}")
+                    details.append(f"⏳ 跳过 (未到{due.day}号): {rule_name}")
+            elif outcome == recurring.UNSUPPORTED:
+                if rule.get("frequency") == "Yearly":
+                    warnings.append(f"⚠️ 未处理 (年付订阅缺少开始日期, 请在订阅管理中补充): {rule_name}")
                 else:
-                    details.append(f"⏭️ 跳过 (本期已付): {rule_name}")
-        
-        if count_added > 0:
-            return f"成功添加 {count_added} 笔订阅:\n" + "\n".join(details)
+                    warnings.append(f"⚠️ 未处理 (不支持的周期 {rule.get('frequency')}): {rule_name}")
+
+        if added:
+            return f"成功添加 {len(added)} 笔订阅:\n" + "\n".join(details + warnings)
         else:
             debug_msg = "✅ 所有到期订阅已记录 (No new items).\n"
-            return debug_msg
+            return debug_msg + "\n".join(warnings)
 
     except Exception as e:
+        # Some chunks may have been written
+        _invalidate(supabase, "expenses")
+        _invalidate(supabase, "recurring_rules")
         return f"检查失败: {e}"
@@ -0,0 +1,68 @@
+import os
+import hashlib
+import tempfile
+import pandas as pd
+import modules.ledger as ledger
+
+# Optional: snapshots need pyarrow for Parquet. Without it they are disabled
+# and every cold start downloads the ledger as before.
+try:
+    import pyarrow  # noqa: F401
+    ENABLED = True
+except ImportError:
+    ENABLED = False
+
+SNAPSHOT_DIR = ".ledger_cache"
+
+def _path(owner):
+    # Hash the user id so file names do not expose it
+    name = hashlib.sha256(str(owner).encode("utf-8")).hexdigest()[:24]
+    return os.path.join(SNAPSHOT_DIR, f"{name}.parquet")
+
+def load(owner):
+    """
+    Returns the user's last saved ledger (canonical frame), or None.
+    """
+    if not ENABLED:
+        return None
+    path = _path(owner)
+    if not os.path.exists(path):
+        return None
+    try:
+        df = pd.read_parquet(path)
+    except Exception as e:
+        print(f"Failed to read snapshot: {e}")
+        delete(owner)
+        return None
+    if list(df.columns) != ledger.COLUMNS:
+        # Written by an older schema; ignore it
+        return None
+    df["category"] = df["category"].astype(ledger.CATEGORY_DTYPE)
+    df["source"] = df["source"].astype("category")
+    df.attrs["complete"] = True
+    return df
+
+def save(owner, df):
+    """
+    Writes the full-history frame atomically (temp file + rename), so a
+    concurrent reader never sees a half-written snapshot.
+    """
+    if not ENABLED:
+        return
+    tmp = None
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        # Unique per call: sessions of one process save from different threads
+        fd, tmp = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".tmp")
+        os.close(fd)
+        df[ledger.COLUMNS].to_parquet(tmp, index=False)
+        os.replace(tmp, _path(owner))
+    except Exception as e:
+        print(f"Failed to save snapshot: {e}")
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+def delete(owner):
+    path = _path(owner)
+    if os.path.exists(path):
+        os.remove(path)
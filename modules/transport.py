@@ -0,0 +1,66 @@
+import httpx
+import streamlit as st
+from supabase import create_client
+import modules.metrics as metrics
+
+# =========================================================
+# Shared HTTP transport
+# ---------------------------------------------------------
+# Every browser session still gets its own Supabase client (it carries that
+# user's auth state and JWT, which is sent with each request), but all
+# clients send through ONE keep-alive connection pool per server process.
+# TLS handshakes and sockets are shared instead of multiplied per session.
+# =========================================================
+POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+REQUEST_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+
+def _http2_available():
+    # HTTP/2 multiplexes concurrent requests over one connection; needs `h2`
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _accept_encoding():
+    # Only advertise what httpx can decode here
+    encodings = ["gzip", "deflate"]
+    try:
+        import brotli  # noqa: F401
+        encodings.append("br")
+    except ImportError:
+        pass
+    return ", ".join(encodings)
+
+class _SharedTransport(httpx.HTTPTransport):
+    """
+    Pool owned by the process. Sessions come and go, and closing one of their
+    clients must not tear down connections the others are using.
+    """
+    def close(self):
+        pass
+
+@st.cache_resource
+def get_shared_transport():
+    return _SharedTransport(http2=_http2_available(), limits=POOL_LIMITS, retries=1)
+
+def create_session_client(url, key):
+    """
+    Creates a per-session Supabase client on top of the shared pool.
+    Falls back to a plain client on supabase-py versions without
+    `ClientOptions(httpx_client=...)`.
+    """
+    http_client = httpx.Client(
+        transport=get_shared_transport(),
+        timeout=REQUEST_TIMEOUT,
+        headers={"Accept-Encoding": _accept_encoding()},
+        follow_redirects=True,
+        # Attributes response bytes and HTTP errors to the services call
+        event_hooks={"response": [metrics.on_response]},
+    )
+    try:
+        from supabase import ClientOptions
+        options = ClientOptions(httpx_client=http_client)
+    except (ImportError, TypeError):
+        return create_client(url, key)
+    return create_client(url, key, options=options)
@@ -1,4 +1,3 @@
-import time
 import pandas as pd
 import streamlit as st
 import plotly.express as px
@@ -6,6 +5,9 @@ import plotly.graph_objects as go
 import datetime
 import pytz
 import modules.services as services
+import modules.ledger as ledger
+import modules.changeset as changeset
+import modules.metrics as metrics
 import modules.utils as utils
 import modules.i18n as i18n
 from modules.i18n import _
@@ -316,19 +318,39 @@ def navigate_to(page_key):
     else:
         st.session_state["v2_nav_radio"] = None
 
+def month_daily_trend(df, services, supabase):
+    """
+    Daily totals of the current month with the columns the trend charts plot (日期, 有效金额).
+    """
+    tz = pytz.timezone("Asia/Shanghai")
+    now = pd.Timestamp.now(tz=tz)
+    totals = services.get_daily_totals(supabase, now.replace(day=1).date(), now.date())
+    if totals is not None:
+        return totals.rename(columns={"day": "日期", "total": "有效金额"})[["日期", "有效金额"]]
+    month_df = df[df["month"] == ledger.month_code(now)]
+    trend = month_df.groupby("date")["amount_cents"].sum().reset_index()
+    return pd.DataFrame({"日期": trend["date"], "有效金额": ledger.money(trend["amount_cents"])})
+
+def category_totals_local(df):
+    """
+    Local stand-in for services.get_category_totals (columns: category, total).
+    """
+    sums = df.groupby("category", observed=True)["amount_cents"].sum()
+    return pd.DataFrame({"category": sums.index.astype(object), "total": ledger.money(sums.to_numpy())})
+
 def render_budget_cards(df, services, supabase, is_mobile=False):
-    budgets = services.get_budgets(supabase)
+    snap = services.get_month_snapshot(supabase, df)
+    budgets = snap.budgets
     tz = pytz.timezone("Asia/Shanghai")
     now = pd.Timestamp.now(tz=tz)
-    this_month_str = now.strftime("%Y-%m")
     
     user = st.session_state.get("user")
     user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
     
     # Date Calculations for Timeline
-    days_in_month = now.days_in_month
-    current_day = now.day
-    days_left = days_in_month - current_day
+    days_in_month = snap.days_in_month
+    current_day = snap.day
+    days_left = snap.days_left
     time_pct = (current_day / days_in_month) * 100
     
     # Start and End of month strings
@@ -336,11 +358,6 @@ def render_budget_cards(df, services, supabase, is_mobile=False):
     end_str = now.replace(day=days_in_month).strftime("%b %d")
     
     if budgets:
-        # Prepare data
-        df_budget_calc = df.copy()
-        if "月(yyyy-mm)" in df_budget_calc.columns:
-            df_budget_calc = df_budget_calc[df_budget_calc["月(yyyy-mm)"] == this_month_str]
-        
         # Grid layout
         cols = st.columns(2) 
         icon_map = {
@@ -350,17 +367,15 @@ def render_budget_cards(df, services, supabase, is_mobile=False):
 
         for i, b in enumerate(budgets):
             with cols[i % 2]:
-                spent = df_budget_calc[df_budget_calc["分类"] == b["category"]]["有效金额"].sum() if "分类" in df_budget_calc.columns else 0
-                limit = b["amount"]
-                left = limit - spent
+                limit = b.limit
+                left = b.left
                 
-                pct = spent / limit if limit > 0 else 0
+                pct = b.pct
                 pct_clamped = min(pct, 1.0) * 100
                 
                 # Daily Advice
                 if days_left > 0 and left > 0:
-                    daily_budget = left / days_left
-                    advice_text = _("advice_daily").format(currency=user_currency, amount=int(daily_budget), days=days_left)
+                    advice_text = _("advice_daily").format(currency=user_currency, amount=int(b.daily_allowance), days=days_left)
                 elif left <= 0:
                     advice_text = _("advice_over")
                 else: # Last day
@@ -381,7 +396,7 @@ def render_budget_cards(df, services, supabase, is_mobile=False):
                     bar_color = "linear-gradient(90deg, #0f2027, #2F80ED)" # Dark Blue to Blue (Low)
                     text_color = "#2F80ED"
                 
-                icon = icon_map.get(b["category"], "💰")
+                icon = icon_map.get(b.category, "💰")
                 
                 # --- RESPONSIVE STYLE & HTML GENERATION ---
                 if is_mobile:
@@ -404,7 +419,7 @@ def render_budget_cards(df, services, supabase, is_mobile=False):
 <div class="bc-top">
 <div class="bc-cat-row">
 <div class="bc-icon-box" style="font-size: 1.5rem;">{icon}</div>
-<div class="bc-cat-name">{_(f"cat_{b['category']}")}</div>
+<div class="bc-cat-name">{_(f"cat_{b.category}")}</div>
 </div>
 <div style="text-align: right; margin-top: 4px;">
 <span class="bc-amount-big">{user_currency}{left:,.0f}</span>
@@ -431,7 +446,7 @@ def render_budget_cards(df, services, supabase, is_mobile=False):
                     top_html = f"""
 <div class="bc-top">
 <div class="bc-cat-row">
-<div class="bc-cat-name">{_(f"cat_{b['category']}")}</div>
+<div class="bc-cat-name">{_(f"cat_{b.category}")}</div>
 <div class="bc-icon-box" style="font-size: 1.8rem;">{icon}</div>
 </div>
 <div class="bc-amount-big">{user_currency}{left:,.0f}</div>
@@ -568,38 +583,14 @@ def render_top_navigation(df, services, supabase, is_mobile=False):
         return
 
     # KPIs Calculation
-    tz = pytz.timezone("Asia/Shanghai")
-    this_month = pd.Timestamp.now(tz=tz).strftime("%Y-%m")
-    
-    if "月(yyyy-mm)" in df.columns:
-        month_df = df[df["月(yyyy-mm)"] == this_month]
-        month_total = month_df["有效金额"].sum()
-        count = len(month_df)
-    else:
-        month_total = 0
-        count = 0
-        
-    budgets = services.get_budgets(supabase)
-    budget_total = sum([b["amount"] for b in budgets])
-    
-    # Calculate Remaining Budget correctly: Sum of (Budget - Spent) for each category
-    # This prevents non-budgeted spending from affecting the "Remaining Budget" KPI
-    left = 0
-    if budgets:
-        # Prepare data for calculation
-        df_calc = df.copy()
-        if "月(yyyy-mm)" in df_calc.columns:
-            df_calc = df_calc[df_calc["月(yyyy-mm)"] == this_month]
-            
-        for b in budgets:
-            spent = df_calc[df_calc["分类"] == b["category"]]["有效金额"].sum() if "分类" in df_calc.columns else 0
-            remaining = b["amount"] - spent
-            left += remaining
-    else:
-        left = 0
-    
-    subs = services.get_recurring_rules(supabase)
-    active_subs = len(subs)
+    snap = services.get_month_snapshot(supabase, df)
+    month_total = snap.total
+    count = snap.count
+    budget_total = snap.budget_total
+    # Remaining Budget: Sum of (Budget - Spent) for each budgeted category, so
+    # non-budgeted spending does not affect the "Remaining Budget" KPI
+    left = snap.budget_left
+    active_subs = snap.active_subscriptions
 
     user = st.session_state.get("user")
     user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
@@ -638,13 +629,15 @@ def render_top_navigation(df, services, supabase, is_mobile=False):
         """, unsafe_allow_html=True)
         st.button(" ", key="btn_subs_ghost", use_container_width=True, on_click=navigate_to, args=("Subscriptions",))
 
-def render_heatmap(supabase, is_mobile=False):
-    # Load data for 6 months (~182 days)
-    data = services.get_daily_activity(supabase, days=200) 
-    if not data: return
+def render_heatmap(supabase, is_mobile=False, df=None):
+    # Load data for 6 months (~182 days); index i is day (today - 200 + i)
+    window_days = 200
+    data = services.get_daily_activity(supabase, days=window_days, df=df)
+    if not data.any(): return
     
     tz = pytz.timezone("Asia/Shanghai")
     today = datetime.datetime.now(tz).date()
+    window_start = today - datetime.timedelta(days=window_days)
     
     # Responsive Settings
     if is_mobile:
@@ -669,7 +662,7 @@ def render_heatmap(supabase, is_mobile=False):
     for i in range(days_to_show):
         d = start_date + datetime.timedelta(days=i)
         d_str = d.strftime("%Y-%m-%d")
-        amount = data.get(d_str, 0)
+        amount = data[(d - window_start).days]
         
         # Color scale (Money based)
         if amount == 0: color = "#2d333b"
@@ -752,21 +745,18 @@ def render_desktop_dashboard(df, services, supabase, is_mobile=False):
     with c_heat:
         # Wrap Heatmap in Streamlit Container for consistent styling
         with st.container(border=True):
-            render_heatmap(supabase)
+            render_heatmap(supabase, df=df)
         
     with c_trend:
         # Wrap Trend in Streamlit Container for consistent styling
         with st.container(border=True):
             st.markdown(f'<div class="kpi-title" style="margin-bottom:15px;">📉 {_( "tab_trend" )}</div>', unsafe_allow_html=True)
             
-            tz = pytz.timezone("Asia/Shanghai")
-            this_month = pd.Timestamp.now(tz=tz).strftime("%Y-%m")
-            
             user = st.session_state.get("user")
             user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
             
-            if "月(yyyy-mm)" in df.columns:
-                daily_trend = df[df["月(yyyy-mm)"] == this_month].groupby("日期")["有效金额"].sum().reset_index()
+            if "month" in df.columns:
+                daily_trend = month_daily_trend(df, services, supabase)
                 if not daily_trend.empty:
                     fig = px.area(daily_trend, x="日期", y="有效金额", title="", color_discrete_sequence=["#56CCF2"])
                     fig.update_traces(hovertemplate="%{x}<br>" + user_currency + "%{y:,.2f}<extra></extra>")
@@ -787,9 +777,8 @@ def render_desktop_dashboard(df, services, supabase, is_mobile=False):
     # Recent Records (Grouped)
     st.markdown(f'<div class="kpi-title" style="margin-top:20px; margin-bottom:15px;">🕒 {_( "dash_recent_records" )}</div>', unsafe_allow_html=True)
     
-    if not df.empty:
-        # Sort and Group
-        df_sorted = df.sort_values(by=["date", "id"], ascending=[False, False]).head(20)
+    df_sorted = services.get_recent_expenses(supabase, 20)
+    if not df_sorted.empty:
         
         tz = pytz.timezone("Asia/Shanghai")
         now_cn = datetime.datetime.now(tz)
@@ -802,7 +791,7 @@ def render_desktop_dashboard(df, services, supabase, is_mobile=False):
         user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
         
         for idx, row in df_sorted.iterrows():
-            d_str = pd.to_datetime(row["日期"]).strftime("%Y-%m-%d")
+            d_str = row["date"].strftime("%Y-%m-%d")
             
             # Determine Group Header
             if d_str == today_str: group_name = _("today")
@@ -814,7 +803,7 @@ def render_desktop_dashboard(df, services, supabase, is_mobile=False):
                 current_group = group_name
             
             # Icon mapping
-            cat = row["分类"]
+            cat = row["category"]
             icon_map = {
                 "餐饮": "🍔", "日用品": "🛒", "交通": "🚗", "服饰": "👔", 
                 "医疗": "💊", "娱乐": "🎮", "居住": "🏠", "其他": "📦"
@@ -830,11 +819,11 @@ def render_desktop_dashboard(df, services, supabase, is_mobile=False):
                         {icon}
                     </div>
                     <div>
-                        <div style="color:#eee; font-weight:500;">{row['项目']}</div>
-                        <div style="color:#666; font-size:0.8rem;">{cat_display} • {row.get('备注','')}</div>
+                        <div style="color:#eee; font-weight:500;">{row['item']}</div>
+                        <div style="color:#666; font-size:0.8rem;">{cat_display} • {row['note'] or ''}</div>
                     </div>
                 </div>
-                <div style="color:#FF4B4B; font-weight:600;">-{user_currency}{row['有效金额']:,.0f}</div>
+                <div style="color:#FF4B4B; font-weight:600;">-{user_currency}{ledger.money(row['amount_cents']):,.0f}</div>
             </div>
             """, unsafe_allow_html=True)
             
@@ -865,20 +854,22 @@ def render_analysis(df, services, supabase, is_mobile=False):
     c1, c2 = st.columns(2)
     with c1:
         st.subheader(_("tab_category_ratio"))
-        if not df.empty and "分类" in df.columns:
+        if not df.empty:
              # Prepare Data with Icons
              icon_map = {
                 "餐饮": "🍔", "日用品": "🛒", "交通": "🚗", "服饰": "👔", 
                 "医疗": "💊", "娱乐": "🎮", "居住": "🏠", "其他": "📦"
              }
              
-             df_pie = df.copy()
-             df_pie["IconLabel"] = df_pie["分类"].apply(lambda x: f"{icon_map.get(x, '💰')} {x}")
+             df_pie = services.get_category_totals(supabase)
+             if df_pie is None:
+                 df_pie = category_totals_local(df)
+             df_pie["IconLabel"] = df_pie["category"].astype(object).map(lambda x: f"{icon_map.get(x, '💰')} {x}")
              
              user = st.session_state.get("user")
              user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
              
-             fig = px.pie(df_pie, names="IconLabel", values="有效金额", hole=0.6, 
+             fig = px.pie(df_pie, names="IconLabel", values="total", hole=0.6, 
                  color_discrete_sequence=["#2F80ED", "#56CCF2", "#6FCF97", "#F2C94C", "#BB6BD9", "#EB5757", "#9B51E0", "#2D9CDB"])
              fig.update_traces(
                  textinfo='percent+label', 
@@ -900,12 +891,15 @@ def render_analysis(df, services, supabase, is_mobile=False):
              
     with c2:
         st.subheader(_("tab_monthly"))
-        if not df.empty and "月(yyyy-mm)" in df.columns:
+        if not df.empty:
             user = st.session_state.get("user")
             user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
             
-            monthly = df.groupby("月(yyyy-mm)")["有效金额"].sum().reset_index()
-            fig = px.bar(monthly, x="月(yyyy-mm)", y="有效金额", text_auto=".2s")
+            monthly = services.get_monthly_totals(supabase)
+            if monthly is None:
+                sums = df.groupby("month")["amount_cents"].sum()
+                monthly = pd.DataFrame({"month": [ledger.month_label(m) for m in sums.index], "total": ledger.money(sums.to_numpy())})
+            fig = px.bar(monthly, x="month", y="total", text_auto=".2s")
             fig.update_traces(
                 marker_color='#2F80ED', 
                 marker_line_width=0, 
@@ -934,9 +928,8 @@ def render_subscriptions(df, services, supabase, is_mobile=False):
     user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
 
     # 1. Summary Cards
-    total_monthly = sum([r["amount"] for r in rules if r["frequency"] == "Monthly"]) + \
-                    sum([r["amount"] * 4 for r in rules if r["frequency"] == "Weekly"]) + \
-                    sum([r["amount"] / 12 for r in rules if r["frequency"] == "Yearly"])
+    # Same figure as the dashboard (Weekly counts 52/12 times a month)
+    total_monthly = services.get_month_snapshot(supabase, df).subscription_load
                     
     c1, c2 = st.columns(2)
     with c1:
@@ -969,6 +962,10 @@ def render_subscriptions(df, services, supabase, is_mobile=False):
     st.subheader(_("sub_list_header"))
     if rules:
         df_rules = pd.DataFrame(rules)
+        # Projects without the start_date migration have no such column: edit without it
+        has_start = "start_date" in df_rules
+        df_rules["start_date"] = pd.to_datetime(df_rules.get("start_date", pd.Series(pd.NaT, index=df_rules.index)), errors="coerce").dt.date
+        r_cols = ["name", "amount", "frequency", "day"] + (["start_date"] if has_start else []) + ["category"]
         df_rules["delete"] = False
         
         r_cfg = {
@@ -978,11 +975,12 @@ def render_subscriptions(df, services, supabase, is_mobile=False):
             "delete": st.column_config.CheckboxColumn("🗑️", width="small", default=False),
             "category": st.column_config.SelectboxColumn(_("col_category"), options=CATEGORIES, width="small"),
             "frequency": st.column_config.SelectboxColumn(_("sub_form_freq"), options=["Monthly", "Weekly", "Yearly"], width="small"),
+            "start_date": st.column_config.DateColumn(_("sub_form_date"), width="small"),
             "id": None, "user_id": None, "active": None, "created_at": None, "last_triggered": None
         }
 
         edited_r = st.data_editor(
-            df_rules[["id", "name", "amount", "frequency", "day", "category", "delete"]], 
+            df_rules[["id"] + r_cols + ["delete"]], 
             column_config=r_cfg, 
             use_container_width=True, 
             hide_index=True, 
@@ -992,32 +990,26 @@ def render_subscriptions(df, services, supabase, is_mobile=False):
         
         col_btn, _empty = st.columns([1, 2])
         if col_btn.button(_("btn_save_changes"), type="primary", use_container_width=True):
-                 # Deletes
-                 to_delete_r = edited_r[edited_r["delete"] == True]
-                 for idx, row in to_delete_r.iterrows(): services.delete_recurring(supabase, row["id"])
-                 
-                 curr_r_ids = set(df_rules["id"].tolist())
-                 new_r_ids = set([r["id"] for i, r in edited_r.iterrows() if "id" in r and pd.notna(r["id"])])
-                 for d_id in (curr_r_ids - new_r_ids): services.delete_recurring(supabase, d_id)
-
-                 # Updates
-                 for idx, row in edited_r.iterrows():
-                     if row["delete"] == True: continue
-                     if "id" in row and pd.notna(row["id"]):
-                          try: 
-                              services.update_recurring(supabase, row["id"], {
-                                  "name": row["name"], 
-                                  "amount": float(row["amount"]), 
-                                  "day": int(row["day"]),
-                                  "frequency": row["frequency"],
-                                  "category": row["category"]
-                              })
-                          except: pass
-                 
-                 st.success(_("msg_sub_updated"))
-                 time.sleep(1)
-                 st.cache_data.clear()
-                 st.rerun()
+                 # Only inserted, modified and deleted rows are sent
+                 edited_r["day"] = edited_r["day"].round().astype("Int64")
+                 r_changes = changeset.diff_frames(
+                     df_rules, edited_r,
+                     columns=r_cols,
+                     delete_col="delete",
+                     required=["name", "amount", "frequency", "day", "category"]
+                 )
+                 for r in r_changes.inserts: r["active"] = True
+                 # Yearly rules take their month from start_date (without one they are never charged)
+                 today = pd.Timestamp.now(tz=pytz.timezone("Asia/Shanghai")).date()
+                 for r in r_changes.inserts + r_changes.update_rows:
+                     if has_start and r.get("frequency") == "Yearly" and r.get("start_date") is None:
+                         r["start_date"] = today
+                 if services.apply_changes(supabase, "recurring_rules", r_changes):
+                     st.toast(_("msg_sub_updated"))
+                     st.cache_data.clear()
+                     st.rerun()
+                 else:
+                     st.error(_("msg_save_failed"))
 
 def render_transactions(df, services, supabase, is_mobile=False):
     render_top_navigation(df, services, supabase, is_mobile=is_mobile)
@@ -1030,16 +1022,17 @@ def render_transactions(df, services, supabase, is_mobile=False):
     with c2:
         search = st.text_input(_("tx_search"), placeholder=_("tx_search_placeholder"))
         
-    df_show = df.copy()
+    df_show = df
     if filter_cat:
-        df_show = df_show[df_show["分类"].isin(filter_cat)]
+        df_show = df_show[df_show["category"].isin(filter_cat)]
     if search:
-        df_show = df_show[df_show["项目"].str.contains(search, case=False) | df_show["备注"].str.contains(search, case=False)]
+        df_show = df_show[df_show["item"].str.contains(search, case=False, na=False) | df_show["note"].str.contains(search, case=False, na=False)]
         
     # Data Editor
     st.caption(_("tx_found_records").format(count=len(df_show)))
     
     edit_cols = ["删除", "日期", "项目", "金额", "分类", "备注", "id"]
+    df_show = ledger.to_display(df_show)
     df_show["删除"] = False
     
     user = st.session_state.get("user")
@@ -1065,14 +1058,19 @@ def render_transactions(df, services, supabase, is_mobile=False):
             height=600
         )
         if st.form_submit_button(_("btn_save_changes"), type="primary"):
-            # Update Logic (Simplified reuse)
-            to_delete = edited[edited["删除"] == True]
-            for id_val in to_delete["id"]: services.delete_expense(supabase, id_val)
-            
-            st.success(_("msg_op_success"))
-            time.sleep(1)
-            st.cache_data.clear()
-            st.rerun()
+            # Only modified and deleted rows are sent
+            tx_changes = changeset.diff_frames(
+                df_show, edited,
+                columns=["日期", "项目", "金额", "分类", "备注"],
+                delete_col="删除",
+                rename={"日期": "date", "项目": "item", "金额": "amount", "分类": "category", "备注": "note"}
+            )
+            if services.apply_changes(supabase, "expenses", tx_changes):
+                st.toast(_("msg_op_success"))
+                st.cache_data.clear()
+                st.rerun()
+            else:
+                st.error(_("msg_save_failed"))
 
 def render_chat(df, services, supabase, user, is_mobile=False):
     render_top_navigation(df, services, supabase, is_mobile=is_mobile)
@@ -1335,28 +1333,22 @@ def render_budgets(df, services, supabase, user, is_mobile=False):
         )
         
         if st.button(_("budget_btn_save"), key="v2_save_budgets_page", type="primary", use_container_width=True):
-            # Handle Deletes
-            to_delete = edited_b[edited_b["delete"] == True]
-            for idx, row in to_delete.iterrows():
-                    if "id" in row and pd.notna(row["id"]): services.delete_budget(supabase, row["id"])
-            
-            # Implicit Deletes
-            current_ids = set(df_budgets["id"].tolist())
-            new_ids = set([r["id"] for i, r in edited_b.iterrows() if "id" in r and pd.notna(r["id"])])
-            for d_id in (current_ids - new_ids): services.delete_budget(supabase, d_id)
-
-            # Updates
-            for idx, row in edited_b.iterrows():
-                if row["delete"] == True: continue
-                if "id" in row and pd.notna(row["id"]):
-                        try:
-                            services.update_budget(supabase, row["id"], {"category": row["category"], "amount": float(row["amount"])})
-                        except: pass
-            
-            st.success(_("budget_msg_updated"))
-            time.sleep(1)
-            st.cache_data.clear()
-            st.rerun()
+            # Only inserted, modified and deleted rows are sent
+            b_changes = changeset.diff_frames(
+                df_budgets, edited_b,
+                columns=["category", "amount"],
+                delete_col="delete",
+                required=["category", "amount"]
+            )
+            icon_map = {"餐饮":"🍔", "交通":"🚗", "日用品":"🛒", "服饰":"👔", "娱乐":"🎮", "医疗":"💊", "居住":"🏠", "其他":"📦"}
+            for b in b_changes.inserts:
+                b.update({"name": f"{b['category']}预算", "color": "#2F80ED", "icon": icon_map.get(b["category"], "💰")})
+            if services.apply_changes(supabase, "budgets", b_changes):
+                st.toast(_("budget_msg_updated"))
+                st.cache_data.clear()
+                st.rerun()
+            else:
+                st.error(_("msg_save_failed"))
 
 def render_settings(supabase, user, is_mobile=False):
     if is_mobile:
@@ -1663,28 +1655,10 @@ def render_settings(supabase, user, is_mobile=False):
 # ==========================================
 def render_unified_kpi_card(df, services, supabase):
     # KPIs Calculation
-    tz = pytz.timezone("Asia/Shanghai")
-    this_month = pd.Timestamp.now(tz=tz).strftime("%Y-%m")
-    
-    if "月(yyyy-mm)" in df.columns:
-        month_df = df[df["月(yyyy-mm)"] == this_month]
-        month_total = month_df["有效金额"].sum()
-    else:
-        month_total = 0
-        
-    budgets = services.get_budgets(supabase)
-    
-    left = 0
-    if budgets:
-        df_calc = df.copy()
-        if "月(yyyy-mm)" in df_calc.columns:
-            df_calc = df_calc[df_calc["月(yyyy-mm)"] == this_month]
-        for b in budgets:
-            spent = df_calc[df_calc["分类"] == b["category"]]["有效金额"].sum() if "分类" in df_calc.columns else 0
-            left += (b["amount"] - spent)
-            
-    subs = services.get_recurring_rules(supabase)
-    active_subs = len(subs)
+    snap = services.get_month_snapshot(supabase, df)
+    month_total = snap.total
+    left = snap.budget_left
+    active_subs = snap.active_subscriptions
 
     user = st.session_state.get("user")
     user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
@@ -1943,15 +1917,17 @@ def render_mobile_dashboard(df, services, supabase, user):
     
     # 2. Category Pie Chart (Analysis)
     st.subheader(f"📊 {_('tab_category_ratio')}")
-    if not df.empty and "分类" in df.columns:
+    if not df.empty:
          icon_map = {"餐饮": "🍔", "日用品": "🛒", "交通": "🚗", "服饰": "👔", "医疗": "💊", "娱乐": "🎮", "居住": "🏠", "其他": "📦"}
-         df_pie = df.copy()
-         df_pie["IconLabel"] = df_pie["分类"].apply(lambda x: f"{icon_map.get(x, '💰')} {_(f'cat_{x}')}")
+         df_pie = services.get_category_totals(supabase)
+         if df_pie is None:
+             df_pie = category_totals_local(df)
+         df_pie["IconLabel"] = df_pie["category"].astype(object).map(lambda x: f"{icon_map.get(x, '💰')} {_(f'cat_{x}')}")
          
          user = st.session_state.get("user")
          user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
          
-         fig = px.pie(df_pie, names="IconLabel", values="有效金额", hole=0.6, 
+         fig = px.pie(df_pie, names="IconLabel", values="total", hole=0.6, 
              color_discrete_sequence=["#2F80ED", "#56CCF2", "#6FCF97", "#F2C94C", "#BB6BD9", "#EB5757", "#9B51E0", "#2D9CDB"])
          fig.update_traces(
              textinfo='percent+label', 
@@ -1968,13 +1944,11 @@ def render_mobile_dashboard(df, services, supabase, user):
 
     # 4. Trend Chart
     st.subheader(f"📉 {_('kpi_trend')}")
-    tz = pytz.timezone("Asia/Shanghai")
-    this_month = pd.Timestamp.now(tz=tz).strftime("%Y-%m")
-    if "月(yyyy-mm)" in df.columns:
+    if "month" in df.columns:
         user = st.session_state.get("user")
         user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
         
-        daily_trend = df[df["月(yyyy-mm)"] == this_month].groupby("日期")["有效金额"].sum().reset_index()
+        daily_trend = month_daily_trend(df, services, supabase)
         if not daily_trend.empty:
             fig = px.area(daily_trend, x="日期", y="有效金额", title="", color_discrete_sequence=["#56CCF2"])
             fig.update_traces(hovertemplate="%{x}<br>" + _("col_amount") + ": " + user_currency + "%{y:,.2f}<extra></extra>")
@@ -1992,26 +1966,26 @@ def render_mobile_dashboard(df, services, supabase, user):
     # 5. Heatmap
     with st.container():
         # st.markdown('<div style="margin-top:20px;"></div>', unsafe_allow_html=True) # Removed spacer
-        render_heatmap(supabase, is_mobile=True)
+        render_heatmap(supabase, is_mobile=True, df=df)
 
     # 6. Recent Records
     st.subheader(f"📝 {_('dash_recent_records')}")
-    if not df.empty:
-        df_sorted = df.sort_values(by=["date", "id"], ascending=[False, False]).head(5)
+    df_sorted = services.get_recent_expenses(supabase, 5)
+    if not df_sorted.empty:
         user = st.session_state.get("user")
         user_currency = user.user_metadata.get("currency_symbol", "$").split(" ")[0] if user else "$"
         
         for idx, row in df_sorted.iterrows():
-            cat = row["分类"]
+            cat = row["category"]
             icon_map = {"餐饮": "🍔", "日用品": "🛒", "交通": "🚗", "服饰": "👔", "医疗": "💊", "娱乐": "🎮", "居住": "🏠", "其他": "📦"}
             icon = icon_map.get(cat, "💰")
             st.markdown(f"""
             <div style="display:flex; justify-content:space-between; align-items:center; padding:12px 16px; background:#181818; border-radius:12px; margin-bottom:8px; border:1px solid #2A2A2A;">
                 <div style="display:flex; align-items:center; gap:12px;">
                     <div style="font-size:1.2rem;">{icon}</div>
-                    <div style="font-weight:500; font-size:0.95rem; color:#eee;">{row['项目']}</div>
+                    <div style="font-weight:500; font-size:0.95rem; color:#eee;">{row['item']}</div>
                 </div>
-                <div style="font-size:0.95rem; font-weight:600; color:#FF4B4B;">-{user_currency}{row['有效金额']:,.0f}</div>
+                <div style="font-size:0.95rem; font-weight:600; color:#FF4B4B;">-{user_currency}{ledger.money(row['amount_cents']):,.0f}</div>
             </div>
             """, unsafe_allow_html=True)
 
@@ -2023,11 +1997,13 @@ def render_mobile_dashboard(df, services, supabase, user):
 # MAIN RENDER ENTRY
 # ==========================================
 def render(supabase):
+    services.begin_rerun()
     inject_custom_css()
     
     # Device Detection
     device_type = utils.get_device_type()
     # device_type = "mobile" # Force mobile for testing CSS overrides
+    metrics.begin_rerun("Mobile" if device_type == "mobile" else st.session_state.get("v2_page", "Dashboard"))
     
     if device_type == "mobile":
         # Inject Mobile Specific CSS Overrides to compact the UI
@@ -2064,8 +2040,9 @@ def render(supabase):
         # New Mobile View Entry
         user = st.session_state.get("user")
         if user:
-            df = services.load_expenses(supabase)
+            df = services.load_dashboard_bundle(supabase)["expenses"]
             render_mobile_dashboard(df, services, supabase, user)
+            render_metrics_footer()
             return
         
     # Desktop View Entry (Original Logic)
@@ -2088,7 +2065,9 @@ def render(supabase):
     
     page = st.session_state["v2_page"]
     
-    df = services.load_expenses(supabase)
+    # Ledger, budgets and subscriptions are fetched concurrently; the
+    # renderers' get_budgets / get_recurring_rules calls then hit the cache.
+    df = services.load_dashboard_bundle(supabase)["expenses"]
     
     if page == "Dashboard":
         render_desktop_dashboard(df, services, supabase, is_mobile=(device_type == "mobile"))
@@ -2104,3 +2083,11 @@ def render(supabase):
         render_settings(supabase, st.session_state["user"], is_mobile=(device_type == "mobile"))
     elif page == "Smart Chat":
         render_chat(df, services, supabase, st.session_state["user"], is_mobile=(device_type == "mobile"))
+
+    render_metrics_footer()
+
+def render_metrics_footer():
+    # Debug panel (if enabled in secrets) and Prometheus textfile export
+    with st.sidebar:
+        metrics.render_debug_panel()
+    metrics.flush()
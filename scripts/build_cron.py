@@ -0,0 +1,58 @@
+"""
+Packs the cron job into one self-contained zipapp:
+
+    python scripts/build_cron.py            # -> dist/cron_job.pyz
+    SUPABASE_URL=... SUPABASE_KEY=... python dist/cron_job.pyz --verbose
+
+The archive holds scripts/cron_job.py and the modules it imports
+(modules/recurring.py, modules/restclient.py, modules/fakerest.py), all
+standard library only, so it runs on any Python 3.9+ without a pip install
+or a checkout.
+Modules are byte-compiled for the building interpreter (zipimport cannot
+cache bytecode itself); other versions fall back to the sources.
+"""
+import os
+import sys
+import shutil
+import zipapp
+import argparse
+import tempfile
+import py_compile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# (source, path inside the archive)
+FILES = [
+    ("scripts/cron_job.py", "cron_job.py"),
+    ("modules/__init__.py", "modules/__init__.py"),
+    ("modules/recurring.py", "modules/recurring.py"),
+    ("modules/restclient.py", "modules/restclient.py"),
+    # --dry-run / --benchmark stand-in
+    ("modules/fakerest.py", "modules/fakerest.py"),
+]
+
+def build(target, compile_bytecode=True):
+    with tempfile.TemporaryDirectory() as staging:
+        for source, name in FILES:
+            path = os.path.join(staging, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(os.path.join(ROOT, source), path)
+            if compile_bytecode:
+                # zipimport reads X.pyc placed next to X.py
+                py_compile.compile(path, cfile=path + "c", dfile=name, doraise=True)
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        zipapp.create_archive(staging, target, interpreter="/usr/bin/env python3",
+                              main="cron_job:main", compressed=True)
+    return target
+
+def main():
+    parser = argparse.ArgumentParser(description="Build dist/cron_job.pyz.")
+    parser.add_argument("--output", default=os.path.join(ROOT, "dist", "cron_job.pyz"))
+    parser.add_argument("--no-compile", action="store_true", help="Ship sources only.")
+    args = parser.parse_args()
+
+    target = build(args.output, compile_bytecode=not args.no_compile)
+    print(f"📦 {os.path.relpath(target)} ({os.path.getsize(target) / 1024:.0f} KiB, Python {sys.version.split()[0]})")
+
+if __name__ == "__main__":
+    main()
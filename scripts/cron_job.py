@@ -1,131 +1,272 @@
+import time
+PROCESS_STARTED = time.perf_counter()
+
 import os
-import pandas as pd
-from supabase import create_client, Client
+import sys
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import modules.recurring as recurring
+import modules.restclient as restclient
+
+# Standard library only (modules/restclient.py instead of supabase-py): no
+# pip install before the run, and it ships as one zipapp (scripts/build_cron.py).
+IMPORTS_MS = (time.perf_counter() - PROCESS_STARTED) * 1000
+# Warn when imports and setup take longer than this before any work starts
+STARTUP_BUDGET_MS = 150
 
 # --- Configuration ---
 # GitHub Actions will provide these environment variables
 url = os.environ.get("SUPABASE_URL")
 key = os.environ.get("SUPABASE_KEY")
 
-if not url or not key:
-    print("❌ Error: SUPABASE_URL or SUPABASE_KEY environment variables not found.")
-    print("Please set these in your GitHub Repository Secrets.")
-    exit(1)
+UUID_SPACE = 1 << 128
 
-# Initialize Client
-supabase: Client = create_client(url, key)
+def parse_shard(value):
+    """
+    "i/n" -> (i, n) with 0 <= i < n.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/n, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must satisfy 0 <= i < n")
+    return index, count
+
+def _uuid(n):
+    h = f"{n:032x}"
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
 
-def get_recurring_rules():
+def shard_bounds(index, count):
+    """
+    [low, high) user_id range of a shard. User ids are random UUIDs, so equal
+    slices of the UUID space hold about the same number of tenants, and the
+    filter runs in Postgres: each runner only reads its own rules.
+    """
+    low = _uuid(UUID_SPACE * index // count)
+    high = _uuid(UUID_SPACE * (index + 1) // count) if index + 1 < count else None
+    return low, high
+
+def group_by_user(rules):
+    users = {}
+    for rule in rules:
+        users.setdefault(rule["user_id"], []).append(rule)
+    return users
+
+def run_batch(supabase, users, day):
+    """
+    Processes a batch of users with one engine run (one upsert for all of
+    them). If that fails, each user is retried on its own so one tenant's
+    bad data cannot block the others; conflicts on (rule_id, period_key)
+    make retrying rows that were already written harmless.
+    Returns (outcomes, {user_id: error}).
+    """
+    rules = [rule for user_rules in users.values() for rule in user_rules]
     try:
-        response = supabase.table("recurring_rules").select("*").eq("active", True).execute()
-        return response.data
+        return recurring.process(supabase, rules, day=day, source="github_action"), {}
+    except Exception:
+        if len(users) == 1:
+            raise
+    outcomes, failures = [], {}
+    for user_id, user_rules in users.items():
+        try:
+            outcomes.extend(recurring.process(supabase, user_rules, day=day, source="github_action"))
+        except Exception as e:
+            failures[user_id] = e
+    return outcomes, failures
+
+def print_outcomes(outcomes):
+    for rule, outcome, due in outcomes:
+        rule_name = rule.get("name")
+        freq = rule.get("frequency", "Monthly")
+        if outcome == recurring.ADDED:
+            print(f"   ✅ Added {rule_name} ({freq}) on {due}")
+        elif outcome == recurring.ALREADY_PAID:
+            print(f"   👌 {rule_name}: already recorded for this period.")
+        elif outcome == recurring.NOT_DUE:
+            print(f"   ⏳ Skip ({freq}) {rule_name}: due on {due}.")
+        else:
+            print(f"   ⏭️ Skip {rule_name}: frequency {freq} not supported (Yearly rules need a start_date).")
+
+class Phases:
+    """
+    Wall time and round trips per phase, reported by --benchmark. Round
+    trips are counted by the in-memory stand-in (modules/fakerest.py).
+    """
+    def __init__(self, client):
+        self.client = client
+        self.rows = []
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        counting = hasattr(self.client, "round_trips")
+        if counting:
+            self.client.reset_round_trips()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            trips = self.client.round_trips() if counting else {}
+            self.rows.append((name, (time.perf_counter() - started) * 1000, trips))
+
+    def report(self):
+        width = max(len(name) for name, _ms, _trips in self.rows)
+        print(f"\n{'phase':<{width}}  {'time':>10}  round trips")
+        for name, ms, trips in self.rows:
+            detail = ", ".join(f"{label} {n}" for label, n in sorted(trips.items()))
+            print(f"{name:<{width}}  {ms:>8.1f}ms  {sum(trips.values()):>5}  {detail}".rstrip())
+        total = sum(sum(trips.values()) for _name, _ms, trips in self.rows)
+        print(f"{'total':<{width}}  {sum(ms for _n, ms, _t in self.rows):>8.1f}ms  {total:>5}")
+
+def dry_run_client(args, phases):
+    """
+    In-memory stand-in for the project, seeded with synthetic data.
+    """
+    import modules.fakerest as fakerest
+    client = fakerest.FakeClient(latency_ms=args.latency_ms)
+    phases.client = client
+    with phases("seed"):
+        user_ids = fakerest.seed(client, users=args.users, rules_per_user=args.rules_per_user,
+                                 expenses_per_user=args.expenses_per_user, gap_days=args.gap_days)
+    print(f"🧪 Dry run: {args.users} synthetic users x {args.rules_per_user} rules, "
+          f"{args.expenses_per_user} expenses each, {args.latency_ms:g}ms simulated latency")
+    return client, user_ids
+
+def run_app(client, user_ids):
+    """
+    Benchmark only: services.check_and_process_recurring (the app's
+    subscription check) for each user, signed in as that user. Imports the
+    app, so this needs its dependencies (streamlit, pandas).
+    """
+    import logging
+    import modules.services as services
+    # Outside `streamlit run` every session_state access warns about it
+    # (streamlit resets its loggers' levels, so filter the record instead)
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+        lambda record: "missing ScriptRunContext" not in record.getMessage())
+    for user_id in user_ids:
+        services.check_and_process_recurring(client.as_user(user_id), user_id)
+
+def run_server_side(supabase, verbose):
+    """
+    One RPC does the whole run for every user inside the database (no rules
+    or rows cross the network). Shards and workers do not apply.
+    """
+    print(f"🔄 Starting server-side Recurring Expense Check at {datetime.now()}...")
+    try:
+        rows = recurring.materialize(supabase, source="github_action")
     except Exception as e:
-        print(f"❌ Failed to fetch rules: {e}")
-        return []
+        print(f"❌ materialize_recurring_expenses failed: {e}")
+        sys.exit(1)
+    if verbose:
+        for row in rows:
+            print(f"   ✅ Added rule {row['rule_id']} for {row['period_key']} on {row['date']}")
+    print(f"📅 Added {len(rows)} new records for {len({row['user_id'] for row in rows})} users.")
 
-def main():
-    print(f"🔄 Starting Recurring Expense Check at {datetime.now()}...")
-    
-    rules = get_recurring_rules()
+def run(supabase, args, phases):
+    """
+    One run over this shard's users. Returns (records added, users, {user_id: error}).
+    """
+    print(f"🔄 Starting Recurring Expense Check at {datetime.now()} (shard {args.shard[0]}/{args.shard[1]})...")
+
+    with phases("fetch rules"):
+        try:
+            # Paged through all active rules of this shard's users
+            rules = recurring.fetch_active_rules(supabase, user_range=shard_bounds(*args.shard))
+        except Exception as e:
+            print(f"❌ Failed to fetch rules: {e}")
+            sys.exit(1)
     if not rules:
         print("ℹ️ No active recurring rules found.")
-        return
+        return 0, {}, {}
 
-    today = pd.Timestamp.today()
-    current_day = today.day
-    current_weekday = today.weekday() # 0=Mon
-    current_month_str = today.strftime("%Y-%m")
-    
-    count_added = 0
-    
-    print(f"📅 Today: {today.strftime('%Y-%m-%d')} (Day {current_day}, Weekday {current_weekday})")
+    today = recurring.today()
+    users = group_by_user(rules)
+    user_ids = sorted(users)
+    batches = [{u: users[u] for u in user_ids[i:i + args.batch_size]} for i in range(0, len(user_ids), args.batch_size)]
+    print(f"📅 Today: {today.strftime('%Y-%m-%d')} | {len(rules)} rules, {len(users)} users, {len(batches)} batches")
 
-    for rule in rules:
-        rule_name = rule.get("name")
-        target_day = int(rule.get("day", 1))
-        freq = rule.get("frequency", "Monthly")
-        
-        should_process = False
-        start_date_check = ""
-        end_date_check = ""
-
-        print(f"🔍 Checking: {rule_name} (Freq: {freq}, Due: {target_day})...")
-
-        # --- LOGIC SELECTION ---
-        if freq == "Weekly":
-            # Check period: Monday of this week to Sunday of this week
-            start_of_week = today - pd.Timedelta(days=today.weekday())
-            end_of_week = start_of_week + pd.Timedelta(days=6)
-            
-            start_date_check = start_of_week.strftime("%Y-%m-%d")
-            end_date_check = end_of_week.strftime("%Y-%m-%d")
-            
-            # If today's weekday >= target weekday, it might be due
-            if current_weekday >= target_day:
-                should_process = True
-            else:
-                 print(f"   ⏳ Skip (Weekly): Not reached day {target_day} yet.")
-
-        else: # Default Monthly
-            # Check period: Start of Month to End of Month
-            start_date_check = f"{current_month_str}-01"
-            last_day = pd.Timestamp(today.year, today.month, 1) + pd.offsets.MonthEnd(0)
-            end_date_check = last_day.strftime("%Y-%m-%d")
-            
-            if current_day >= target_day:
-                should_process = True
-            else:
-                 print(f"   ⏳ Skip (Monthly): Not reached day {target_day} yet.")
-        
-        # --- EXECUTION ---
-        if should_process:
+    count_added = 0
+    failures = {}
+    with phases("process batches"), ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(run_batch, supabase, batch, today): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
             try:
-                res = supabase.table("expenses") \
-                    .select("*") \
-                    .eq("item", rule_name) \
-                    .eq("category", rule["category"]) \
-                    .eq("user_id", rule["user_id"]) \
-                    .gte("date", start_date_check) \
-                    .lte("date", end_date_check) \
-                    .execute()
-                
-                if not res.data:
-                    # Not found -> Insert
-                    print(f"   👉 Due and not found. Creating record...")
-                    
-                    # Calculate Date
-                    due_date = today
-                    if freq == "Monthly":
-                        try:
-                            due_date = pd.Timestamp(year=today.year, month=today.month, day=target_day)
-                        except ValueError:
-                             due_date = pd.Timestamp(year=today.year, month=today.month, day=1) + pd.offsets.MonthEnd(0)
-                    elif freq == "Weekly":
-                         start_of_week = today - pd.Timedelta(days=today.weekday())
-                         due_date = start_of_week + pd.Timedelta(days=target_day)
-                    
-                    payload = {
-                        "date": due_date.strftime("%Y-%m-%d"),
-                        "item": rule_name,
-                        "amount": float(rule["amount"]),
-                        "category": rule["category"],
-                        "note": f"🔄 自动订阅 ({freq})",
-                        "source": "github_action",
-                        "user_id": rule["user_id"] 
-                    }
-                    
-                    supabase.table("expenses").insert(payload).execute()
-                    print(f"   ✅ Successfully added {rule_name}")
-                    count_added += 1
-                else:
-                    print(f"   👌 Already recorded for this period.")
-                    
+                outcomes, batch_failures = future.result()
             except Exception as e:
-                print(f"   ❌ Error processing {rule_name}: {e}")
+                outcomes, batch_failures = [], {user_id: e for user_id in batch}
+            failures.update(batch_failures)
+            count_added += sum(1 for _rule, outcome, _due in outcomes if outcome == recurring.ADDED)
+            if args.verbose:
+                print_outcomes(outcomes)
+    return count_added, users, failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Record due recurring expenses for every user.")
+    parser.add_argument("--shard", type=parse_shard, default=(0, 1), metavar="i/n",
+                        help="Process only shard i of n (split tenants across runners).")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent batches.")
+    parser.add_argument("--batch-size", type=int, default=25, help="Users per engine run.")
+    parser.add_argument("--verbose", action="store_true", help="Print every rule's outcome.")
+    parser.add_argument("--server-side", action="store_true",
+                        help="Run everything inside Postgres with one RPC (materialize_recurring_expenses).")
+    dry = parser.add_argument_group("dry run", "Run against an in-memory stand-in with synthetic data; no project needed.")
+    dry.add_argument("--dry-run", action="store_true", help="Use the stand-in instead of SUPABASE_URL.")
+    dry.add_argument("--benchmark", action="store_true", help="Dry run, then report per-phase timings and round trips.")
+    dry.add_argument("--users", type=int, default=1000)
+    dry.add_argument("--rules-per-user", type=int, default=5)
+    dry.add_argument("--expenses-per-user", type=int, default=50)
+    dry.add_argument("--gap-days", type=int, default=30, help="Oldest rule watermark, in days.")
+    dry.add_argument("--latency-ms", type=float, default=0, help="Simulated network latency per request.")
+    dry.add_argument("--app-users", type=int, default=0,
+                     help="Also run the app's check (services.check_and_process_recurring) for this many users first.")
+    args = parser.parse_args()
+    args.dry_run = args.dry_run or args.benchmark
+
+    started = time.perf_counter()
+    startup_ms = (started - PROCESS_STARTED) * 1000
+    print(f"⏱️ Startup {startup_ms:.0f}ms (imports {IMPORTS_MS:.0f}ms)")
+    if startup_ms > STARTUP_BUDGET_MS:
+        print(f"⚠️ Startup exceeded its {STARTUP_BUDGET_MS}ms budget.")
+
+    phases = Phases(None)
+    if args.dry_run:
+        supabase, synthetic_users = dry_run_client(args, phases)
+    else:
+        if not url or not key:
+            print("❌ Error: SUPABASE_URL or SUPABASE_KEY environment variables not found.")
+            print("Please set these in your GitHub Repository Secrets.")
+            sys.exit(1)
+        # Thread-safe; each worker keeps its own keep-alive connection
+        supabase = restclient.Client(url, key)
+        phases.client = supabase
+
+    if args.dry_run and args.app_users:
+        with phases(f"app check ({args.app_users} users)"):
+            run_app(supabase, synthetic_users[:args.app_users])
+
+    if args.server_side:
+        with phases("server-side rpc"):
+            run_server_side(supabase, args.verbose)
+        failures = {}
+        print(f"\n✨ Completed in {time.perf_counter() - started:.1f}s!")
+    else:
+        count_added, users, failures = run(supabase, args, phases)
+        for user_id, error in failures.items():
+            print(f"   ❌ User {user_id}: {error}")
+        elapsed = time.perf_counter() - started
+        print(f"\n✨ Completed in {elapsed:.1f}s! Added {count_added} new records for {len(users) - len(failures)} users.")
 
-    print(f"\n✨ Completed! Added {count_added} new records.")
+    if args.benchmark:
+        phases.report()
+    if failures:
+        print(f"⚠️ {len(failures)} users failed; they will be caught up on the next run.")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,33 @@
+import os
+import sys
+import argparse
+from supabase import create_client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import modules.services as services
+
+# --- Configuration ---
+# Use the service key to migrate every user's rows at once
+url = os.environ.get("SUPABASE_URL")
+key = os.environ.get("SUPABASE_KEY")
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite legacy English categories into CATEGORIES (one-off).")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would change.")
+    args = parser.parse_args()
+
+    if not url or not key:
+        print("❌ Error: SUPABASE_URL or SUPABASE_KEY environment variables not found.")
+        sys.exit(1)
+
+    supabase = create_client(url, key)
+    report = services.migrate_legacy_categories(supabase, dry_run=args.dry_run)
+    if not report:
+        print("✅ All categories are already canonical.")
+        return
+    for table, targets in report.items():
+        for target, old_values in targets.items():
+            print(f"{'🔍' if args.dry_run else '✅'} {table}: {', '.join(map(str, old_values))} -> {target}")
+
+if __name__ == "__main__":
+    main()
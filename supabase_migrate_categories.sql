@@ -0,0 +1,45 @@
+-- =============================================================================
+-- One-off migration: legacy English categories -> Chinese CATEGORIES
+--
+-- INSTRUCTIONS:
+-- 1. Go to your Supabase Project Dashboard -> SQL Editor
+-- 2. Paste the contents of this file
+-- 3. Click "Run"
+--
+-- Mirrors LEGACY_CATEGORY_MAP in modules/ledger.py. Unknown values become '其他',
+-- which is also what the app shows for them. Safe to re-run: rows that are
+-- already canonical are not touched.
+-- Python equivalent: services.migrate_legacy_categories / scripts/migrate_categories.py
+-- =============================================================================
+
+create or replace function pg_temp.canonical_category(raw text)
+returns text language sql immutable as $$
+  select case
+    when raw in ('餐饮', '日用品', '交通', '服饰', '医疗', '娱乐', '居住', '其他') then raw
+    when raw in ('Dining', 'Food') then '餐饮'
+    when raw in ('Transport', 'Transportation') then '交通'
+    when raw in ('Shopping', 'Daily') then '日用品'
+    when raw in ('Housing', 'Home') then '居住'
+    when raw in ('Medical', 'Health') then '医疗'
+    when raw in ('Entertainment', 'Fun') then '娱乐'
+    when raw = 'Clothing' then '服饰'
+    else '其他'
+  end;
+$$;
+
+begin;
+
+update public.expenses
+   set category = pg_temp.canonical_category(category)
+ where category is null
+    or category not in ('餐饮', '日用品', '交通', '服饰', '医疗', '娱乐', '居住', '其他');
+
+update public.budgets
+   set category = pg_temp.canonical_category(category)
+ where category not in ('餐饮', '日用品', '交通', '服饰', '医疗', '娱乐', '居住', '其他');
+
+update public.recurring_rules
+   set category = pg_temp.canonical_category(category)
+ where category not in ('餐饮', '日用品', '交通', '服饰', '医疗', '娱乐', '居住', '其他');
+
+commit;
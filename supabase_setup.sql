@@ -20,9 +20,23 @@ create table public.expenses (
   category text default '其他',
   note text,
   source text default 'manual',
+  updated_at timestamp with time zone default now() not null,
   user_id uuid references auth.users not null default auth.uid()
 );
 
+-- Keep updated_at current so clients can sync incrementally
+create or replace function public.touch_updated_at()
+returns trigger language plpgsql as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$;
+
+create trigger expenses_touch_updated_at
+  before update on public.expenses
+  for each row execute function public.touch_updated_at();
+
 -- Enable Security
 alter table public.expenses enable row level security;
 
@@ -64,7 +78,8 @@ create table public.recurring_rules (
   frequency text not null, -- 'weekly', 'monthly', 'yearly'
   day integer not null,
   active boolean default true,
-  last_run_date date,
+  start_date date, -- first charge; Yearly rules take their month from it
+  last_run_date date, -- watermark: every occurrence up to this date has been recorded
   user_id uuid references auth.users not null default auth.uid()
 );
 
@@ -75,3 +90,323 @@ create policy "Enable insert for recurring" on public.recurring_rules for insert
 create policy "Enable select for recurring" on public.recurring_rules for select using (auth.uid() = user_id);
 create policy "Enable update for recurring" on public.recurring_rules for update using (auth.uid() = user_id);
 create policy "Enable delete for recurring" on public.recurring_rules for delete using (auth.uid() = user_id);
+
+-- Expenses generated by a rule carry the rule and the billing period they
+-- pay ('M:2026-10-01', 'W:2026-10-12', 'Y:2026-01-01': frequency + period
+-- start). The unique key makes recurring inserts idempotent: the engine
+-- upserts with `on conflict do nothing`, so concurrent runners (app and
+-- cron) cannot double-charge and no read-before-write is needed.
+-- Manual expenses leave both null (nulls never conflict).
+alter table public.expenses
+  add column rule_id bigint references public.recurring_rules(id) on delete set null,
+  add column period_key text,
+  add constraint expenses_rule_period_key unique (rule_id, period_key);
+
+
+-- 4. Aggregation Functions
+-- Dashboards call these through `supabase.rpc(...)` and receive one row per
+-- group instead of the raw ledger. They run as the caller (security invoker),
+-- so RLS still applies; the explicit user filter just lets Postgres use the
+-- (user_id, date ...) index of section 6.
+create or replace function public.expense_monthly_totals()
+returns table (month text, total numeric, count bigint)
+language sql stable security invoker as $$
+  select to_char(e.date, 'YYYY-MM'), sum(e.amount), count(*)
+  from public.expenses e
+  where e.user_id = auth.uid()
+  group by 1
+  order by 1;
+$$;
+
+create or replace function public.expense_category_totals(p_start date default null, p_end date default null)
+returns table (category text, total numeric, count bigint)
+language sql stable security invoker as $$
+  select e.category, sum(e.amount), count(*)
+  from public.expenses e
+  where e.user_id = auth.uid()
+    and (p_start is null or e.date >= p_start)
+    and (p_end is null or e.date <= p_end)
+  group by e.category;
+$$;
+
+create or replace function public.expense_daily_totals(p_start date, p_end date)
+returns table (day date, total numeric, count bigint)
+language sql stable security invoker as $$
+  select e.date, sum(e.amount), count(*)
+  from public.expenses e
+  where e.user_id = auth.uid()
+    and e.date between p_start and p_end
+  group by e.date
+  order by e.date;
+$$;
+
+-- 5. Monthly Summary Table
+-- One row per (user, month, category), kept current by statement-level
+-- triggers on expenses. KPI and budget cards read a handful of these rows
+-- instead of scanning the ledger. Clients can only read it; the trigger
+-- function writes as its owner (security definer), and each statement only
+-- touches the rows it changed, so callers still cannot affect other users.
+create table public.monthly_category_totals (
+  user_id uuid references auth.users not null,
+  month date not null, -- first day of the month
+  category text not null,
+  total numeric not null default 0,
+  count bigint not null default 0,
+  primary key (user_id, month, category)
+);
+
+alter table public.monthly_category_totals enable row level security;
+
+create policy "Enable select for monthly totals" on public.monthly_category_totals for select using (auth.uid() = user_id);
+
+create or replace function public.refresh_monthly_category_totals()
+returns trigger language plpgsql security definer set search_path = public as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    with d as (
+      select user_id, date_trunc('month', date)::date as month, coalesce(category, '其他') as category,
+             sum(amount) as total, count(*) as n
+      from old_rows
+      group by 1, 2, 3
+    )
+    update public.monthly_category_totals m
+       set total = m.total - d.total, count = m.count - d.n
+      from d
+     where m.user_id = d.user_id and m.month = d.month and m.category = d.category;
+
+    delete from public.monthly_category_totals m
+     where m.count <= 0 and m.user_id in (select distinct user_id from old_rows);
+  end if;
+
+  if tg_op in ('INSERT', 'UPDATE') then
+    insert into public.monthly_category_totals as m (user_id, month, category, total, count)
+    select user_id, date_trunc('month', date)::date, coalesce(category, '其他'), sum(amount), count(*)
+    from new_rows
+    group by 1, 2, 3
+    on conflict (user_id, month, category)
+    do update set total = m.total + excluded.total, count = m.count + excluded.count;
+  end if;
+  return null;
+end;
+$$;
+
+-- Transition tables allow only one event per trigger
+create trigger expenses_monthly_totals_insert
+  after insert on public.expenses
+  referencing new table as new_rows
+  for each statement execute function public.refresh_monthly_category_totals();
+
+create trigger expenses_monthly_totals_update
+  after update on public.expenses
+  referencing old table as old_rows new table as new_rows
+  for each statement execute function public.refresh_monthly_category_totals();
+
+create trigger expenses_monthly_totals_delete
+  after delete on public.expenses
+  referencing old table as old_rows
+  for each statement execute function public.refresh_monthly_category_totals();
+
+-- 6. Indexes
+-- Every query is scoped to one user (RLS adds `user_id = auth.uid()`), so
+-- each index leads with user_id and then follows one hot access path.
+-- Measured with scripts/bench_indexes.py. Safe to re-run.
+
+-- load_expenses keyset pages (order by date desc, id desc), date ranges of
+-- the heatmap / trend charts and the aggregation functions
+create index if not exists expenses_user_date_id_idx
+  on public.expenses (user_id, date desc, id desc);
+
+-- Incremental sync: rows changed since the watermark
+create index if not exists expenses_user_updated_at_idx
+  on public.expenses (user_id, updated_at);
+
+-- Recurring inserts need no index of their own: the unique
+-- (rule_id, period_key) constraint resolves their conflicts.
+
+-- Only active rules are ever read (app and cron job)
+create index if not exists recurring_rules_user_active_idx
+  on public.recurring_rules (user_id) where active;
+
+create index if not exists budgets_user_idx
+  on public.budgets (user_id);
+
+-- 7. Server-side Recurring Materialization
+-- The same run as modules/recurring.py, as one set-based statement: every
+-- missing occurrence in (last_run_date, today] of every due rule is
+-- inserted (`on conflict do nothing` on (rule_id, period_key), so it can run
+-- alongside the Python engine), and the watermarks move to today. Nothing
+-- crosses the network but the inserted rows.
+--
+--   select * from public.materialize_recurring_expenses();            -- every user
+--   supabase.rpc('materialize_recurring_expenses', {...}).execute()   -- app / cron
+--
+-- It runs as its owner (security definer) to write for every user, so it
+-- decides who may do what itself: a signed-in caller (auth.uid() is set)
+-- only ever materializes their own rules as of today; the service role,
+-- pg_cron and the owner may pass p_user and p_today. anon cannot call it.
+-- Rules without a watermark yet get their current period, if already due.
+create or replace function public.materialize_recurring_expenses(
+  p_today date default null,
+  p_user uuid default null,
+  p_source text default 'recurring_rule'
+)
+returns table (rule_id bigint, user_id uuid, date date, period_key text)
+language sql volatile security definer set search_path = public as $$
+  with args as (
+    select coalesce(case when auth.uid() is null then p_today end,
+                    (now() at time zone 'Asia/Shanghai')::date) as today,
+           coalesce(auth.uid(), p_user) as owner
+  ),
+  rules as (
+    select r.*, a.today,
+           case r.frequency when 'Weekly' then 'week' when 'Yearly' then 'year' else 'month' end as unit,
+           -- first day that may still need a charge
+           greatest(
+             coalesce(r.last_run_date + 1,
+                      date_trunc(case r.frequency when 'Weekly' then 'week' when 'Yearly' then 'year' else 'month' end,
+                                 a.today::timestamp)::date),
+             coalesce(r.start_date, '-infinity'::date)
+           ) as first_day
+    from public.recurring_rules r, args a
+    where r.active
+      and (a.owner is null or r.user_id = a.owner)
+      and (r.last_run_date is null or r.last_run_date < a.today)
+      and r.frequency in ('Weekly', 'Monthly', 'Yearly')
+      and (r.frequency <> 'Yearly' or r.start_date is not null)
+  ),
+  occurrences as (
+    -- One row per billing period overlapping [first_day, today]
+    select r.id, r.user_id, r.name, r.amount, r.category, r.frequency, r.first_day, r.today,
+           p::date as period_start,
+           case r.frequency
+             when 'Weekly' then p::date + least(greatest(r.day, 0), 6)
+             when 'Yearly' then (
+               select m + least(greatest(r.day, 1),
+                                extract(day from m + interval '1 month - 1 day')::int) - 1
+               from (select make_date(extract(year from p)::int, extract(month from r.start_date)::int, 1) as m) y)
+             else p::date + least(greatest(r.day, 1),
+                                  extract(day from p + interval '1 month - 1 day')::int) - 1
+           end as due
+    from rules r,
+         generate_series(date_trunc(r.unit, r.first_day::timestamp), r.today::timestamp, ('1 ' || r.unit)::interval) p
+    where r.first_day <= r.today
+  ),
+  inserted as (
+    insert into public.expenses (date, item, amount, category, note, source, user_id, rule_id, period_key)
+    select o.due, o.name, o.amount, o.category, '🔄 自动订阅 (' || o.frequency || ')', p_source,
+           o.user_id, o.id, left(o.frequency, 1) || ':' || o.period_start
+    from occurrences o
+    where o.due between o.first_day and o.today
+    on conflict on constraint expenses_rule_period_key do nothing
+    returning expenses.rule_id, expenses.user_id, expenses.date, expenses.period_key
+  ),
+  advanced as (
+    update public.recurring_rules r
+       set last_run_date = rules.today
+      from rules
+     where r.id = rules.id
+  )
+  select * from inserted;
+$$;
+
+revoke execute on function public.materialize_recurring_expenses(date, uuid, text) from public, anon;
+grant execute on function public.materialize_recurring_expenses(date, uuid, text) to authenticated, service_role;
+
+-- Optional: run it inside the database every day instead of (or next to)
+-- the GitHub Action. Enable the pg_cron extension (Dashboard -> Database ->
+-- Extensions), then:
+--
+--   select cron.schedule('materialize-recurring', '5 16 * * *',  -- 00:05 Asia/Shanghai
+--                        $$select count(*) from public.materialize_recurring_expenses(p_source => 'pg_cron')$$);
+--
+-- Measured with scripts/bench_recurring.py.
+
+-- =============================================================================
+-- UPGRADING AN EXISTING PROJECT
+-- The statements below are safe to re-run. Use them instead of the
+-- `create table` blocks above when the tables already exist.
+-- =============================================================================
+
+-- Incremental sync watermark (services.load_expenses)
+alter table public.expenses add column if not exists updated_at timestamp with time zone default now() not null;
+
+create or replace function public.touch_updated_at()
+returns trigger language plpgsql as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$;
+
+drop trigger if exists expenses_touch_updated_at on public.expenses;
+create trigger expenses_touch_updated_at
+  before update on public.expenses
+  for each row execute function public.touch_updated_at();
+
+-- Recurring catch-up (modules/recurring.py): first charge date of each rule
+alter table public.recurring_rules add column if not exists start_date date;
+
+-- Yearly rules need start_date for their month; rules created before it
+-- existed take it from their creation date (otherwise they are skipped)
+update public.recurring_rules
+   set start_date = (created_at at time zone 'Asia/Shanghai')::date
+ where frequency = 'Yearly' and start_date is null;
+
+-- Idempotent recurring inserts: rule_id / period_key and their unique key
+alter table public.expenses add column if not exists rule_id bigint references public.recurring_rules(id) on delete set null;
+alter table public.expenses add column if not exists period_key text;
+
+do $$
+begin
+  if not exists (select 1 from pg_constraint where conname = 'expenses_rule_period_key') then
+    alter table public.expenses add constraint expenses_rule_period_key unique (rule_id, period_key);
+  end if;
+end;
+$$;
+
+-- The engine no longer looks up earlier charges by item and category
+drop index if exists public.expenses_user_item_category_date_idx;
+
+-- Link expenses recorded by earlier versions (matched on user, item and
+-- category) to their rule and period, one row per period, so the engine
+-- does not charge the current period again. Safe to re-run.
+with matched as (
+  select e.id, r.id as rule_id,
+         left(r.frequency, 1) || ':' || date_trunc(
+           case r.frequency when 'Weekly' then 'week' when 'Yearly' then 'year' else 'month' end,
+           e.date)::date as period_key
+  from public.expenses e
+  join public.recurring_rules r
+    on r.user_id = e.user_id and r.name = e.item and r.category = e.category
+  where e.rule_id is null and e.source in ('recurring_rule', 'github_action')
+),
+ranked as (
+  select m.*, row_number() over (partition by m.rule_id, m.period_key order by m.id) as n
+  from matched m
+  where not exists (
+    select 1 from public.expenses x where x.rule_id = m.rule_id and x.period_key = m.period_key
+  )
+)
+update public.expenses e
+   set rule_id = ranked.rule_id, period_key = ranked.period_key
+  from ranked
+ where e.id = ranked.id and ranked.n = 1;
+
+-- Aggregation functions: re-run section "4. Aggregation Functions" above
+-- (every statement there is `create or replace`).
+
+-- Monthly summary table: run section "5. Monthly Summary Table" above once,
+-- then backfill it from the existing ledger (safe to re-run; rebuilds it):
+begin;
+lock table public.expenses in share mode;
+delete from public.monthly_category_totals;
+insert into public.monthly_category_totals (user_id, month, category, total, count)
+select user_id, date_trunc('month', date)::date, coalesce(category, '其他'), sum(amount), count(*)
+from public.expenses
+group by 1, 2, 3;
+commit;
+
+-- Indexes: re-run section "6. Indexes" above (every statement is `if not exists`).
+
+-- Server-side recurring materialization: run section "7. Server-side Recurring
+-- Materialization" above (`create or replace`, then the grants).